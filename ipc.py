@@ -21,6 +21,19 @@ ___ = tb.no_except
 
 PICKLE_PROTOCOL = 4
 
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+def _min_tmo(tmo_s, deadline):
+    # return: shorter of tmo_s and time left to deadline (seconds,
+    #         threadutil.Deadline or None), or None if both are None.
+    if deadline is None:
+        return tmo_s
+    if isinstance(deadline, tu.Deadline):
+        deadline = deadline.remaining()
+        if deadline is None:
+            return tmo_s
+    return deadline if tmo_s is None else min(tmo_s, deadline)
+
 
 #----------------------------------------------------------------------------
 #                          simple socket wrappter
@@ -103,43 +116,77 @@ class CSocket(object):
         except:
             pass
 
+    # wait_readable/wait_writable raise threadutil.Canceled if the waiting
+    # thread is canceled (see threadutil.cancel_fd).
+
+    # tmo_s of wait_readable/wait_writable can be seconds, threadutil.Deadline
+    # or None. deadline of recv_x/send_x bounds whole transfer in addition
+    # to per-wait *_tmo_s attributes.
+
+    def _wait(self, rl, wl, tmo_s, cfd):
+        if cfd is None:
+            rok, wok, _ = select.select(rl, wl, [], tmo_s)
+            return bool(rok or wok)
+        rok, wok, _ = select.select(rl + [cfd], wl, [], tmo_s)
+        if cfd in rok:
+            raise tu.Canceled()
+        return bool(rok or wok)
+
     def wait_readable(self, tmo_s=None):
-        rok, _, _ = select.select([self._sock], [], [], tmo_s)
-        return bool(rok)
+        return self._wait([self._sock], [], _min_tmo(None, tmo_s), tu.cancel_fd())
 
     def wait_writable(self, tmo_s=None):
-        _, wok, _ = select.select([], [self._sock], [], tmo_s)
-        return bool(wok)
+        return self._wait([], [self._sock], _min_tmo(None, tmo_s), tu.cancel_fd())
 
-    def recv_x(self, size):
+    def recv_x(self, size, deadline=None):
         # return: (data, rest_size)
-        # exception: socket.timeout, socket.error
+        # exception: socket.timeout, socket.error, threadutil.Canceled
         data = bytes()
         tmo_s = self.init_recv_tmo_s
+        if deadline is not None:
+            deadline = tu.Deadline.of(deadline)
+        cfd = tu.cancel_fd()
+        rl = [self._sock]
+        waits = (tmo_s is not None) or (cfd is not None) or (deadline is not None)
         while size > 0:
-            if (tmo_s is not None) and (not self.wait_readable(tmo_s)):
-                raise socket.timeout('recv timeout: %f' % tmo_s)
+            if waits:
+                w_tmo_s = _min_tmo(tmo_s, deadline)
+                if not self._wait(rl, [], w_tmo_s, cfd):
+                    raise socket.timeout('recv timeout: %f' % w_tmo_s)
             s = self._sock.recv(size)
             if not s:
                 return data, size
             size -= len(s)
             data += s
             tmo_s = self.next_recv_tmo_s
+            waits = (tmo_s is not None) or (cfd is not None) or (deadline is not None)
         return data, 0
 
-    def send_x(self, buf, size=None):
-        # exception: socket.timeout, socket.error
+    def send_x(self, buf, size=None, deadline=None):
+        # exception: socket.timeout, socket.error, threadutil.Canceled
         if size is None:
             size = len(buf)
         buf = memoryview(buf)[:size]
         tmo_s = self.send_tmo_s
+        if deadline is not None:
+            deadline = tu.Deadline.of(deadline)
+        cfd = tu.cancel_fd()
+        wl = [self._sock]
+        waits = (tmo_s is not None) or (cfd is not None) or (deadline is not None)
+        # send only what fits after waiting, so that each wait can time out
+        # or be canceled instead of blocking in send until all is sent.
+        flags = _MSG_DONTWAIT if waits else 0
         while size > 0:
-            if (tmo_s is not None) and (not self.wait_writable(tmo_s)):
-                raise socket.timeout('send timeout: %f' % tmo_s)
-            n = self._sock.send(buf)
+            if waits:
+                w_tmo_s = _min_tmo(tmo_s, deadline)
+                if not self._wait([], wl, w_tmo_s, cfd):
+                    raise socket.timeout('send timeout: %f' % w_tmo_s)
+            try:
+                n = self._sock.send(buf, flags)
+            except BlockingIOError:
+                continue
             size -= n
             buf = buf[n:]
-            tmo_s = self.send_tmo_s
 
     def shutdown(self, m):
         try:
@@ -198,7 +245,7 @@ class PyPacker(PackerBase):
         n = len(s)
         return struct.pack('<i', n)+s, n+4
         
-    def unpack(self, csock):
+    def recv_frame(self, csock):
         s, n = csock.recv_x(4)
         if not s:
             raise NoMoreData('Peer maybe finish sending data')
@@ -210,7 +257,10 @@ class PyPacker(PackerBase):
         s, n = csock.recv_x(n)
         if n != 0:
             raise EOFError('Unexpected disconnection (error)')
-        return _pickle.loads(s)
+        return s
+
+    def unpack(self, csock):
+        return _pickle.loads(self.recv_frame(csock))
 
 class JSONPacker(PackerBase):
     MAX_PACKED = (1024*1024*16)
@@ -253,7 +303,10 @@ class ServiceBase(object):
 
     def sendto_all(self, msg):
         for p in self.__ports[:]:
-            p.send(msg)
+            try:
+                p.send(msg)
+            except tu.Queue.AlreadyStopped:
+                pass			# port is now closing.
 
     def call_handler(self, port, msg):
         fn = 'handle_' + str(msg[0])
@@ -279,13 +332,14 @@ class ServiceBase(object):
 
 class IPCPort(object):
     _counter = tb.Counter()
+    SEND_BATCH = 64		# messages taken from send queue at once
 
     def __new__(cls, service_object, packer, csock):
         self = super().__new__(cls)
         self._service = service_object
         self._packer = packer if packer else PyPacker()
         self._csock = csock
-        self._send_queue = tu.Queue()
+        self._send_queue = tu.HandoffQueue()
         self._send_error = None
         self.order = self._counter()
         return self
@@ -293,15 +347,19 @@ class IPCPort(object):
     def __repr__(self):
         return '<IPCPort#%d>' % self.order
 
+    @property
+    def packer(self):
+        return self._packer
+
     def _send_loop(self):
         msg = None
         try:
             while True:
-                msg = self._send_queue.get()
-                if msg is False:
-                    return
-                s, n = self._packer.pack(msg)
-                self._csock.send_x(s, n)
+                for msg in self._send_queue.get_many(self.SEND_BATCH):
+                    if msg is False:
+                        return
+                    s, n = self._packer.pack(msg)
+                    self._csock.send_x(s, n)
         except Exception as e:
             traceback.print_exc()
             self._send_error = (e, msg)
@@ -349,13 +407,16 @@ class IPCPort(object):
     def start(self, fin_func=None):
         name = '%s#%d' % (type(self._service).__name__, self.order)
 
+        # port threads are never canceled, so skip waits for cancellation.
         t = tu.Thread(target=self._send_thread)
         t.daemon = True
+        t.cancelable = False
         t.name = name + '(S)'
         t.start()
 
         t = tu.Thread(target=self._main_thread, args=(t, fin_func))
         t.daemon = True
+        t.cancelable = False
         t.name = name + '(M)'
         t.start()
 
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import heapq
+import itertools
+import os
+import signal
 import socket
 import struct
 import sys
+import time
 
 
 PICKLE_PROTOCOL = 4
+MIPC_VERSION = 2		# 2: correlation id of autoreply (mipc_call)
 
 
 #----------------------------------------------------------------------------
@@ -24,9 +31,12 @@ def _thread_getlock():
 #### poll
 from . import mpoll
 
+#### thread pool
+from . import threadutil as tu
+
 #### socket.read
 def _recvall(sock, n):
-    s = ''
+    s = b''
     while n:
         s2 = sock.recv(n)
         if not s2:
@@ -34,7 +44,21 @@ def _recvall(sock, n):
         s += s2
         n -= len(s2)
     return s
-        
+
+#### socket.write
+import select
+
+def _sendall(sock, data):
+    # sendall which also works on non-blocking socket.
+    data = memoryview(data)
+    while data:
+        try:
+            n = sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            select.select([], [sock], [])
+            continue
+        data = data[n:]
+
 #### print(exception)
 import traceback
 def _print_exception(e):
@@ -57,6 +81,9 @@ class SocketUnexpectedClosed(PortError):
 class SocketIOError(PortError):
     pass
 
+class IdleTimeout(SocketClosed):
+    pass
+
 class ProtocolError(PortError):
     pass
 
@@ -72,6 +99,9 @@ class PackerBase(object):
         return self
 
 class DumpPackerBase(PackerBase):
+    MAX_PACKED = (1024*1024*16)
+    RECV_SIZE = 65536
+
     @staticmethod
     def dumps(msg):
         raise NotImplementedError()
@@ -92,25 +122,60 @@ class DumpPackerBase(PackerBase):
         if len(size_str) != 4:
             raise SocketUnexpectedClosed()
         n, = struct.unpack('<i', size_str)
+        if not (0 <= n <= self.MAX_PACKED):
+            raise ProtocolError('Packed data size is invalid: %d' % n)
         data = _recvall(sock, n)
         if len(data) != n:
             raise SocketUnexpectedClosed()
         return self.loads(data)
 
+    def unpack_ready(self, sock, buf):
+        # Non-blocking version of unpack. Data read from sock is appended
+        # to buf (bytearray owned by port), and only complete frames are
+        # removed from buf and returned as list of messages.
+        try:
+            data = sock.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not data:
+            if buf:
+                raise SocketUnexpectedClosed()
+            raise SocketClosed()
+        buf += data
+        return self.unpack_buffer(buf)
+
+    def unpack_buffer(self, buf):
+        msgs = []
+        off = 0
+        end = len(buf)
+        while end - off >= 4:
+            n, = struct.unpack_from('<i', buf, off)
+            if not (0 <= n <= self.MAX_PACKED):
+                raise ProtocolError('Packed data size is invalid: %d' % n)
+            if end - off - 4 < n:
+                break
+            msgs.append(self.loads(bytes(buf[off+4:off+4+n])))
+            off += 4 + n
+        if off:
+            del buf[:off]
+        return msgs
+
 class JSONPacker(DumpPackerBase):
     import json
-    dumps = staticmethod(json.dumps)
+    dumps = staticmethod(lambda msg, _dumps=json.dumps: _dumps(msg).encode())
     loads = staticmethod(json.loads)
 
 class PyPacker(DumpPackerBase):
     import _pickle
-    dumps = staticmethod(lambda msg: _pickle.dumps(msg, PICKLE_PROTOCOL))
+    dumps = staticmethod(lambda msg, _dumps=_pickle.dumps: _dumps(msg, PICKLE_PROTOCOL))
     loads = staticmethod(_pickle.loads)
 
 class UDPDumpPackerBase(DumpPackerBase):
 
     MAXLEN = 512
+    RECV_BATCH = 16		# datagrams read by one unpack_from_ready at most
     recv_addr = None
+    dropped = 0			# datagrams discarded (e.g. failed to decode)
 
     def pack(self, msg):
         data = self.dumps(msg)
@@ -119,23 +184,194 @@ class UDPDumpPackerBase(DumpPackerBase):
             raise PortError('UDP data size is too large.')
         return data, n
 
+    def pack_datagrams(self, msg):
+        # list of datagrams to be sent for msg.
+        return [self.pack(msg)[0]]
+
+    def _recvfrom(self, sock):
+        return sock.recvfrom(self.MAXLEN)
+
     def unpack(self, sock):
-        data, addr = sock.recvfrom(self.MAXLEN)
+        data, addr = self._recvfrom(sock)
         self.recv_addr = addr
         return self.loads(data)
 
+    def unpack_datagram(self, data, addr):
+        # message in data, or None if data is only a part of message.
+        return self.loads(data)
+
+    def unpack_from_ready(self, sock, drain=False):
+        # Non-blocking: read RECV_BATCH datagrams at most (or until no more
+        # datagram if drain) and return list of (message, sender address).
+        # Datagram failed to decode is dropped alone, not raised, so that
+        # one bad sender can't close the port shared by others.
+        msgs = []
+        n = self.RECV_BATCH
+        while drain or n:
+            try:
+                data, addr = self._recvfrom(sock)
+            except (BlockingIOError, InterruptedError):
+                break
+            try:
+                msg = self.unpack_datagram(data, addr)
+            except Exception:
+                self.dropped += 1
+                msg = None
+            if msg is not None:
+                msgs.append((msg, addr))
+            n -= 1
+        return msgs
+
+    def unpack_ready(self, sock, buf):
+        # datagram is never fragmented, so buf is not used.
+        msgs = self.unpack_from_ready(sock)
+        if msgs:
+            self.recv_addr = msgs[-1][1]
+        return [msg for msg, _ in msgs]
+
+class UDPFragmentPackerBase(UDPDumpPackerBase):
+    # Message up to MAXLEN is split into datagrams of DATAGRAM_SIZE at most,
+    # each of which has header (message id, index, count), and receiver
+    # reassembles them. Incomplete message is discarded after REASM_TMO_S,
+    # and the oldest one is discarded if REASM_MAX messages are incomplete.
+
+    MAXLEN = (1024*1024)
+    DATAGRAM_SIZE = 1472	# fits in ethernet MTU (1500 - IP/UDP header)
+    REASM_TMO_S = 2.0
+    REASM_MAX = 256
+    RECV_SIZE = 65536
+    _hdr = struct.Struct('<IHH')
+
+    def __init__(self, maxlen=None, datagram_size=None, reasm_tmo_s=None):
+        if maxlen is not None:
+            self.MAXLEN = maxlen
+        if datagram_size is not None:
+            if not (self._hdr.size < datagram_size <= self.RECV_SIZE):
+                raise ValueError('datagram_size is invalid: %d' % datagram_size)
+            self.DATAGRAM_SIZE = datagram_size
+        if reasm_tmo_s is not None:
+            self.REASM_TMO_S = reasm_tmo_s
+        self._msg_id = int.from_bytes(os.urandom(4), 'little')
+        self._reasm = collections.OrderedDict()	# (addr, id): [expire, {index: part}, count, size]
+        self.dropped = 0		# datagrams/messages discarded
+
+    def pack_datagrams(self, msg):
+        data, n = self.pack(msg)
+        step = self.DATAGRAM_SIZE - self._hdr.size
+        count = max((n + step - 1) // step, 1)
+        if count > 0xffff:
+            raise PortError('UDP data size is too large.')
+        self._msg_id = msg_id = (self._msg_id + 1) & 0xffffffff
+        hdr = self._hdr.pack
+        view = memoryview(data)
+        return [hdr(msg_id, i, count) + view[i*step:(i+1)*step]
+                for i in range(count)]
+
+    def _recvfrom(self, sock):
+        return sock.recvfrom(self.RECV_SIZE)
+
+    def unpack(self, sock):
+        # blocking: wait until some message is completed.
+        while True:
+            data, addr = self._recvfrom(sock)
+            msg = self.unpack_datagram(data, addr)
+            if msg is not None:
+                self.recv_addr = addr
+                return msg
+
+    def _expire(self, now):
+        reasm = self._reasm
+        while reasm:
+            key, ent = next(iter(reasm.items()))
+            if ent[0] > now:
+                break
+            del reasm[key]
+            self.dropped += 1
+
+    def unpack_datagram(self, data, addr):
+        hsize = self._hdr.size
+        if len(data) < hsize:
+            self.dropped += 1
+            return None
+        msg_id, index, count = self._hdr.unpack_from(data)
+        # count is bounded by MAXLEN of 1 byte fragments, since sender may
+        # use smaller datagram_size. Parts are filled as they arrive, so
+        # memory is bounded by received size (checked below), not count.
+        if index >= count or count > self.MAXLEN:
+            self.dropped += 1
+            return None
+        if count == 1:
+            return self.loads(data[hsize:])
+        reasm = self._reasm
+        if reasm:
+            self._expire(time.monotonic())
+        key = (addr, msg_id)
+        ent = reasm.get(key)
+        if ent is None:
+            if len(reasm) >= self.REASM_MAX:
+                reasm.popitem(last=False)
+                self.dropped += 1
+            ent = reasm[key] = [time.monotonic() + self.REASM_TMO_S,
+                                {}, count, 0]
+        parts = ent[1]
+        if ent[2] != count:
+            self.dropped += 1
+            return None
+        if index not in parts:
+            parts[index] = data[hsize:]
+            ent[3] += len(data) - hsize
+            if ent[3] > self.MAXLEN:
+                del reasm[key]
+                self.dropped += 1
+                return None
+        if len(parts) < count:
+            return None
+        del reasm[key]
+        return self.loads(b''.join([parts[i] for i in range(count)]))
+
 class UDPJSONPacker(UDPDumpPackerBase):
     import json
-    dumps = staticmethod(json.dumps)
+    dumps = staticmethod(lambda msg, _dumps=json.dumps: _dumps(msg).encode())
+    loads = staticmethod(json.loads)
+
+class UDPFragmentJSONPacker(UDPFragmentPackerBase):
+    import json
+    dumps = staticmethod(lambda msg, _dumps=json.dumps: _dumps(msg).encode())
     loads = staticmethod(json.loads)
 
+class UDPFragmentPyPacker(UDPFragmentPackerBase):
+    import _pickle
+    dumps = staticmethod(lambda msg, _dumps=_pickle.dumps: _dumps(msg, PICKLE_PROTOCOL))
+    loads = staticmethod(_pickle.loads)
+
 
 #----------------------------------------------------------------------------
 #
 #----------------------------------------------------------------------------
 
+def _reply_value(msg):
+    ev, status, value = msg[:3]
+    if status:
+        return value
+    raise RemoteHandlerError('Exception happen on remote:\n' + value)
+
+class _PendingReply(object):
+    __slots__ = ('port', 'cid', 'msg')
+
+    def __init__(self, port, cid):
+        self.port = port
+        self.cid = cid
+        self.msg = None			# reply message
+
+    def done(self):
+        return self.msg is not None
+
+    def result(self):
+        return self.port._wait(self)
+
 class IOPort(object):
     acceptable = False
+    WBUF_LIMIT = (1024*1024*16)		# limit of output buffer (managed port)
 
     def __init__(self, sock=None, packer=None):
         if packer is None:
@@ -144,8 +380,20 @@ class IOPort(object):
             self.socket = sock
         self._packer = packer
         self._lock = _thread_getlock()
+        self._rbuf = bytearray()
+        self._eof = False
+        self._wbuf = None		# bytearray if managed by _ServiceManager
+        self._manager = None
         self._event = None
         self._autoreply_names = set()
+        self._cid = False		# server supports correlation id
+        self._cids = itertools.count(1)
+        self._waiting = {}		# cid: _PendingReply
+        self._r_lock = _thread_getlock()	# held by thread reading replies
+        self._r_cond = tu.Condition()	# signals routed reply/end of reading
+        self._reading = False		# some waiter is reading for all
+        self._r_sleep = 0		# waiters sleeping on _r_cond
+        self.on_message = None		# callback for unsolicited message
         if isinstance(packer, UDPDumpPackerBase):
             self.send = self._send_udp
 
@@ -156,28 +404,114 @@ class IOPort(object):
         return self				# for method chain
 
     def negotiate(self):
-        self._autoreply_names = set(self.send(['mipc_negotiate']).result())
+        # Version 2 server replies dict telling correlation id is available.
+        # Older one ignores version and replies list of autoreply names.
+        names = self.send(['mipc_negotiate', MIPC_VERSION]).result()
+        if isinstance(names, dict):
+            self._cid = bool(names.get('cid'))
+            names = names['names']
+        self._autoreply_names = set(names)
         return self				# for method chain
 
     def recv(self):
         return self._packer.unpack(self.socket)
 
+    def recv_ready(self, drain=False):
+        # non-blocking: return list of messages completely received.
+        # drain: read until no more data (required by edge-triggered poll).
+        #        End of stream found after some messages is reported by
+        #        next call, and eof property becomes True until then.
+        if self._eof:
+            raise SocketClosed()
+        msgs = []
+        while True:
+            n = len(self._rbuf)
+            try:
+                got = self._packer.unpack_ready(self.socket, self._rbuf)
+            except SocketClosed:
+                if not msgs:
+                    raise
+                self._eof = True
+                return msgs
+            msgs.extend(got)
+            if not drain or (not got and len(self._rbuf) == n):
+                return msgs
+
+    def recv_from_ready(self, drain=False):
+        # UDP version of recv_ready: list of (message, sender address).
+        return self._packer.unpack_from_ready(self.socket, drain)
+
+    @property
+    def eof(self):
+        return self._eof
+
     def send(self, msg):
         self._event = msg[0]
         data, n = self._packer.pack(msg)
+        if self._wbuf is not None:
+            return self._send_buffered(data)
+        with self._lock:
+            _sendall(self.socket, data)		# raise exception if error
+        return self
+
+    def attach(self, manager):
+        # Called by manager. After this, send never blocks: data which can't
+        # be written at once is kept in output buffer and flushed by loop.
+        self._manager = manager
+        self._wbuf = bytearray()
+        self._wpending = False
+        self._inq = collections.deque()	# received, not yet dispatched
+        self._busy = False		# offloaded handler is running
+        self._last_recv = self._last_ping = time.monotonic()
+
+    def _send_buffered(self, data):
         with self._lock:
-            self.socket.sendall(data)		# raise exception if error
+            if self.socket is None:
+                raise SocketClosed()
+            if self._wbuf:
+                self._wbuf += data
+            else:
+                try:
+                    n = self.socket.send(data)
+                except (BlockingIOError, InterruptedError):
+                    n = 0
+                if n == len(data):
+                    return self
+                self._wbuf += memoryview(data)[n:]
+                self._manager.want_write(self, True)
+            if len(self._wbuf) > self.WBUF_LIMIT:
+                # Peer doesn't read. Shutdown makes loop find an error on
+                # this port and disconnect it.
+                self._wbuf = bytearray()
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise PortError('Output buffer overflow (peer is not reading).')
         return self
 
+    def flush(self):
+        # Called by manager when socket is writable.
+        with self._lock:
+            if self._wbuf:
+                try:
+                    n = self.socket.send(self._wbuf)
+                except (BlockingIOError, InterruptedError):
+                    n = 0
+                del self._wbuf[:n]
+            if not self._wbuf:
+                self._manager.want_write(self, False)
+
     def _send_udp(self, msg):
         self._event = msg[0]
-        data, n = self._packer.pack(msg)
         with self._lock:
+            datagrams = self._packer.pack_datagrams(msg)
             addr = self._packer.recv_addr
-            if addr:
-                self.socket.sendto(data, addr)
-            else:
-                self.socket.send(data)
+            for data in datagrams:
+                if addr:
+                    self.socket.sendto(data, addr)
+                else:
+                    self.socket.send(data)
         return self
 
     def close(self):
@@ -186,56 +520,209 @@ class IOPort(object):
             self.socket = None
 
     def result(self):
-        ev, status, value = self.recv()
         expect = self._event + '_reply'
-        if ev != expect:
-            raise ProtocolError('%s is expected, but %s is received.' % (expect, ev))
-        if status:
-            return value
-        raise RemoteHandlerError('Exception happen on remote:\n' + value)
+        with self._r_lock:
+            while True:
+                msg = self.recv()
+                if msg[0] == expect and len(msg) == 3:
+                    return _reply_value(msg)
+                if not self._route(msg):
+                    raise ProtocolError('%s is expected, but %s is received.' % (expect, msg[0]))
+
+    # correlation id (pipelining)
+
+    def call_async(self, name, *args):
+        # Send request of autoreply handler and return object whose result()
+        # waits for its reply. Many requests can be outstanding, and replies
+        # are matched by correlation id even if they come out of order.
+        if not self._cid:
+            raise ProtocolError('Correlation id is not supported by server.')
+        pending = _PendingReply(self, next(self._cids))
+        self._waiting[pending.cid] = pending
+        try:
+            self.send(['mipc_call', pending.cid, name] + list(args))
+        except Exception:
+            del self._waiting[pending.cid]
+            raise
+        return pending
+
+    def _wait(self, pending):
+        # One waiter at a time reads (holding _r_lock) and routes each
+        # message to its waiter, and signals it at once. Others sleep until
+        # their reply is routed, or reading is handed over when the reader
+        # gets its own reply.
+        cond = self._r_cond
+        with cond:
+            self._r_sleep += 1		# counted before test of msg
+            try:
+                while pending.msg is None and self._reading:
+                    cond.wait()
+            finally:
+                self._r_sleep -= 1
+            if pending.msg is not None:
+                return _reply_value(pending.msg)
+            self._reading = True
+        try:
+            with self._r_lock:
+                while pending.msg is None:
+                    self._route(self.recv())
+                    if self._r_sleep:
+                        with cond:
+                            cond.notify_all()
+        finally:
+            with cond:
+                self._reading = False
+                cond.notify_all()
+        return _reply_value(pending.msg)
+
+    def _route(self, msg):
+        # return: False if msg is a reply nobody waits.
+        name = msg[0]
+        if name == 'mipc_ping':			# keepalive from manager
+            return True
+        if name.endswith('_reply'):
+            if len(msg) == 4:
+                pending = self._waiting.pop(msg[3], None)
+                if pending is not None:
+                    pending.msg = msg
+                    return True
+            return False
+        if self.on_message is not None:
+            self.on_message(msg)
+        return True				# dropped if no callback
 
     def __getattr__(self, name):
         def _send(*args):
             msg = [name]
             msg.extend(args)
-            self.send(msg)
             if name in self._autoreply_names:
+                if self._cid:
+                    return self.call_async(name, *args).result()
+                self.send(msg)
                 return self.result()
+            self.send(msg)
             return self		# for method chain
         return _send
 
 def client(addr, packer=None):
     return IOPort(packer=packer).connect(addr).negotiate()
 
-def udp_client(addr, packer=None):
+def udp_client(addr, packer=None, tmo_s=5.0):
     if packer is None:
         packer = UDPJSONPacker()
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.connect(addr)
-    sock.settimeout(5.0)	# TODO
+    sock.settimeout(tmo_s)
     return IOPort(sock=sock, packer=packer).negotiate()
 
-def udp_server(addr, packer=None):
+def udp_server(addr, packer=None, tmo_s=5.0):
     if isinstance(addr, int):
         addr = ('0.0.0.0', addr)
     if packer is None:
         packer = UDPJSONPacker()
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(addr)
-    sock.settimeout(5.0)	# TODO
+    sock.settimeout(tmo_s)
     return IOPort(sock=sock, packer=packer)
 
+class UDPPeer(object):
+    # Port-like object standing for one sender of UDPServerPort. Replies
+    # are sent to addr on socket of server port, so that concurrent peers
+    # never receive replies of others.
+    __slots__ = ('server', 'addr', 'service_object', 'last_recv', '_event')
+    acceptable = False
+    _manager = None			# handlers run in loop thread
+
+    def __init__(self, server, addr):
+        self.server = server
+        self.addr = addr
+        self.service_object = None
+        self.last_recv = time.monotonic()
+        self._event = None
+
+    @property
+    def socket(self):
+        return self.server.socket
+
+    def send(self, msg):
+        self._event = msg[0]
+        self.server.sendto(msg, self.addr)
+        return self
+
+    def close(self):
+        # forget session. Next datagram from addr starts new one.
+        if self.server.peers.get(self.addr) is self:
+            del self.server.peers[self.addr]
+
+class UDPServerPort(IOPort):
+    # UDP server port keeping a session (UDPPeer) per sender address.
+    # _ServiceManager calls service_object(peer) and on_accepted for new
+    # peer as for accepted connection, and peer sending nothing for
+    # session_s is expired with on_disconnected. Oldest peer is expired
+    # also when number of peers exceeds SESSION_MAX.
+    SESSION_MAX = 65536
+
+    def __init__(self, sock, packer=None, session_s=60.0):
+        if packer is None:
+            packer = UDPJSONPacker()
+        super().__init__(sock=sock, packer=packer)
+        self.session_s = session_s
+        self.peers = collections.OrderedDict()	# addr: UDPPeer (LRU order)
+
+    def sendto(self, msg, addr):
+        with self._lock:
+            for data in self._packer.pack_datagrams(msg):
+                self.socket.sendto(data, addr)
+
+    def peer(self, addr):
+        # return: (peer, True if new)
+        peer = self.peers.get(addr)
+        if peer is not None:
+            peer.last_recv = time.monotonic()
+            self.peers.move_to_end(addr)
+            return peer, False
+        peer = self.peers[addr] = UDPPeer(self, addr)
+        return peer, True
+
+    def expired(self, now=None):
+        # remove and return peers to be expired.
+        peers = self.peers
+        limit = (now or time.monotonic()) - self.session_s
+        expired = []
+        while peers:
+            peer = next(iter(peers.values()))
+            if peer.last_recv > limit and len(peers) <= self.SESSION_MAX:
+                break
+            expired.append(peers.popitem(last=False)[1])
+        return expired
+
+def udp_session_server(addr, packer=None, session_s=60.0):
+    if isinstance(addr, int):
+        addr = ('0.0.0.0', addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(addr)
+    return UDPServerPort(sock, packer=packer, session_s=session_s)
+
 class AcceptablePort(object):
     acceptable = True
 
-    def __init__(self, sock_addr, packer=None):
+    def __init__(self, sock_addr, packer=None, backlog=1, reuseport=False):
         self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            # each process binds same address and kernel distributes
+            # incoming connections among them.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(sock_addr)
-        self.socket.listen(1)
+        self.socket.listen(backlog)
         self._packer = packer
 
     def accept(self):
-        iosocket, _ = self.socket.accept()
+        # return: new IOPort, or None if no connection is pending.
+        try:
+            iosocket, _ = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return None
         packer = self._packer
         return IOPort(sock=iosocket,
                       packer=(packer() if packer else None))
@@ -261,13 +748,18 @@ class _AutoReply(object):
         else:
             def wrapper(svc_self, port, msg):	# args: self, port, msg
                 reply = msg[0] + '_reply'
+                cid = getattr(msg, 'cid', ())	# only if request carried it
+                if cid != ():
+                    cid = (cid,)
                 try:
                     ret = target(svc_self, *msg[1:])
-                    port.send([reply, True, ret])
+                    port.send([reply, True, ret, *cid])
                 except Exception as e:
-                    port.send([reply, False, str(e)])
+                    port.send([reply, False, str(e), *cid])
                     _print_exception(e)
             wrapper.__name__ = target.__name__
+            if getattr(target, '_mipc_offload', False):
+                wrapper._mipc_offload = True
             self._autoreply_names.add(target.__name__)
             return wrapper
 
@@ -280,6 +772,21 @@ _AutoReply = _AutoReply()
 autoreply =_AutoReply.decorator_autoreply
 noreply = _AutoReply.decorator_noreply
 
+def offload(target):
+    # Handler decorated by offload runs on threadutil.threadpool instead of
+    # loop thread of _ServiceManager (like rpc.export without quick).
+    # It can be combined with autoreply in any order.
+    target._mipc_offload = True
+    return target
+
+class _CallMsg(list):
+    # [name, *args] unwrapped from ['mipc_call', cid, name, *args]
+    __slots__ = ('cid',)
+
+    def __init__(self, msg, cid):
+        super().__init__(msg)
+        self.cid = cid
+
 class _ServiceMeta(type):
     def __new__(mcls, name, bases, dic):
         cls = super().__new__(mcls, name, bases, dic)
@@ -295,12 +802,26 @@ class ServiceBase(object, metaclass=_ServiceMeta):
     # mipc_ prefixed methods are reserved for internal.
 
     def mipc_negotiate(self, port, msg):
-        port.send(['mipc_negotiate_reply', True, list(self._autoreply_names)])
+        names = list(self._autoreply_names)
+        if len(msg) > 1 and msg[1] >= 2:
+            port.send(['mipc_negotiate_reply', True, {'names': names, 'cid': True}])
+        else:
+            port.send(['mipc_negotiate_reply', True, names])
+
+    def mipc_call(self, port, msg):
+        self.mipc_received(port, _CallMsg(msg[2:], msg[1]))
+
+    def mipc_ping(self, port, msg):
+        pass
 
     def mipc_received(self, port, msg):
         name = msg[0]
         if hasattr(self, name):
-            getattr(self, name)(port, msg)
+            handler = getattr(self, name)
+            if getattr(handler, '_mipc_offload', False) and port._manager:
+                port._manager.offload(port, self, handler, msg)
+            else:
+                handler(port, msg)
         else:
             self.on_default(port, msg)
 
@@ -318,59 +839,397 @@ class ServiceBase(object, metaclass=_ServiceMeta):
     def on_exception(self, port):
         pass
 
+class _Timer(object):
+    __slots__ = ('when', 'interval', 'func', 'args', 'cancelled')
+
+    def __init__(self, when, interval, func, args):
+        self.when = when
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
 class _ServiceManager(object):
-    def __init__(self):
-        self._poll = mpoll.poll()
+    def __init__(self, start=True, edge=False, maxevents=-1):
+        self._poll = mpoll.poll(edge, maxevents)
         self._ports = {}
+        self._timers = []		# heap of _Timer
+        self._t_lock = _thread_getlock()
+        self._idle_timer = None
+        self.idle_s = None
+        self.keepalive_s = None
         self.ip_address = '0.0.0.0'
-        _thread_start(self.loop, ())
+        if start:
+            _thread_start(self.loop, ())
 
-    def register_server(self, addr, service_object, packer=None):
+    def register_server(self, addr, service_object, packer=None,
+                        backlog=1, reuseport=False):
         if isinstance(addr, int):
             addr = (self.ip_address, addr)
-        port = AcceptablePort(addr, packer=packer)
+        port = AcceptablePort(addr, packer=packer,
+                              backlog=backlog, reuseport=reuseport)
         self.register(port, service_object)
 
+    def register_udp_server(self, addr, service_object, packer=None,
+                            session_s=60.0):
+        if isinstance(addr, int):
+            addr = (self.ip_address, addr)
+        self.register(udp_session_server(addr, packer, session_s),
+                      service_object)
+
     def register(self, port, service_object):
         fd = port.socket.fileno()
-        self._poll.register(port.socket, mpoll.POLLIN)
-        self._ports[fd] = (port, service_object)
+        port.socket.setblocking(False)
+        if not (port.acceptable or isinstance(port._packer, UDPDumpPackerBase)):
+            port.attach(self)
+        if isinstance(port, UDPServerPort):
+            itv_s = max(port.session_s / 4.0, 0.05)
+            port._session_timer = self.call_every(
+                itv_s, self._expire_peers, port)
+        entry = (port, service_object)
+        self._poll.register(port.socket, mpoll.POLLIN, entry)
+        self._ports[fd] = entry
 
     def unregister(self, port):
         fd = port.socket.fileno()
         self._poll.unregister(port.socket)
         if fd in self._ports:
             del self._ports[fd]
+        if isinstance(port, UDPServerPort):
+            port._session_timer.cancel()
+
+    def call_soon(self, func, *args):
+        # thread safe: func is called in loop thread.
+        self._poll.call_soon(func, *args)
+
+    # timers
+
+    def _add_timer(self, timer):
+        with self._t_lock:
+            heapq.heappush(self._timers, timer)
+            earliest = self._timers[0] is timer
+        if earliest:
+            # loop may sleep with longer timeout.
+            self._poll.call_soon(lambda:None)
+        return timer
+
+    def call_later(self, delay_s, func, *args):
+        # thread safe: return timer object which has cancel method.
+        return self._add_timer(_Timer(time.monotonic() + delay_s, None,
+                                      func, args))
+
+    def call_every(self, interval_s, func, *args):
+        # thread safe: return timer object which has cancel method.
+        return self._add_timer(_Timer(time.monotonic() + interval_s,
+                                      interval_s, func, args))
+
+    def _run_timers(self):
+        # return: timeout (seconds) until next timer, or -1 if no timer.
+        while True:
+            with self._t_lock:
+                if not self._timers:
+                    return -1
+                timer = self._timers[0]
+                now = time.monotonic()
+                if timer.cancelled:
+                    heapq.heappop(self._timers)
+                    continue
+                if timer.when > now:
+                    return timer.when - now
+                heapq.heappop(self._timers)
+                if timer.interval is not None:
+                    timer.when = max(timer.when + timer.interval, now)
+                    heapq.heappush(self._timers, timer)
+            try:
+                timer.func(*timer.args)
+            except Exception as e:
+                _print_exception(e)
+
+    # idle connection
+
+    def set_idle_timeout(self, idle_s=None, keepalive_s=None):
+        # idle_s:      connection receiving nothing for idle_s is closed.
+        # keepalive_s: 'mipc_ping' is sent to connection receiving nothing
+        #              for keepalive_s, to detect dead peer.
+        self.idle_s = idle_s
+        self.keepalive_s = keepalive_s
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        itvs = [v for v in (idle_s, keepalive_s) if v]
+        if itvs:
+            itv_s = max(min(itvs) / 4.0, 0.05)
+            self._idle_timer = self.call_every(itv_s, self._check_idle)
+
+    def _check_idle(self):
+        now = time.monotonic()
+        idle_s = self.idle_s
+        keepalive_s = self.keepalive_s
+        for port, service_object in list(self._ports.values()):
+            if getattr(port, '_manager', None) is not self or port.socket is None:
+                continue
+            if idle_s and now - port._last_recv > idle_s and not port._busy:
+                self._close(port, service_object, IdleTimeout())
+            elif keepalive_s and now - max(port._last_recv, port._last_ping) > keepalive_s:
+                port._last_ping = now
+                try:
+                    port.send(['mipc_ping'])
+                except Exception as e:
+                    self._close(port, service_object, e)
+
+    # attached port control
+
+    def _update_mask(self, port):
+        # require: port._lock must be locked by caller.
+        # Reading is paused while offloaded handler of port is running.
+        mask = 0 if port._busy else mpoll.POLLIN
+        if port._wpending:
+            mask |= mpoll.POLLOUT
+        self._poll.modify(port.socket, mask)
+
+    def want_write(self, port, on):
+        # require: port._lock must be locked by caller.
+        port._wpending = on
+        self._update_mask(port)
+
+    def _set_busy(self, port, busy):
+        with port._lock:
+            port._busy = busy
+            if port.socket:
+                self._update_mask(port)
+
+    # offloading handler to thread pool
+
+    def offload(self, port, service_object, handler, msg):
+        # Until handler finishes, no more message of port is dispatched,
+        # so replies of port are kept in order of requests.
+        self._set_busy(port, True)
+        tu.threadpool.queue(self._offloaded, port, service_object, handler, msg)
+
+    def _offloaded(self, port, service_object, handler, msg):
+        error = None
+        try:
+            handler(port, msg)
+        except Exception as e:
+            error = e
+        self.call_soon(self._resume, port, service_object, error)
+
+    def _resume(self, port, service_object, error):
+        if port.socket is None:		# already closed
+            return
+        if error:
+            self._close(port, service_object, error)
+            return
+        self._set_busy(port, False)
+        try:
+            self._dispatch(port, service_object)
+        except Exception as e:
+            self._close(port, service_object, e)
+
+    # event handling
+
+    def _dispatch(self, port, service_object):
+        inq = port._inq
+        while inq and not port._busy:
+            service_object.mipc_received(port, inq.popleft())
+
+    def _close(self, port, service_object, error):
+        if not isinstance(error, SocketClosed):
+            _print_exception(error)
+        self.unregister(port)
+        if isinstance(port, UDPServerPort):
+            for peer in list(port.peers.values()):
+                peer.service_object.on_disconnected(peer)
+            port.peers.clear()
+        if isinstance(error, SocketClosed):
+            service_object.on_disconnected(port)
+        else:
+            service_object.on_exception(port)
+        port.close()
+
+    # UDP sessions
+
+    def _expire_peers(self, port):
+        for peer in port.expired():
+            try:
+                peer.service_object.on_disconnected(peer)
+            except Exception as e:
+                _print_exception(e)
+
+    def _udp_dispatch(self, port, service_object):
+        for msg, addr in port.recv_from_ready(self._poll.edge):
+            peer, new = port.peer(addr)
+            try:
+                if new:
+                    peer.service_object = service_object(peer)
+                    peer.service_object.on_accepted(peer)
+                peer.service_object.mipc_received(peer, msg)
+            except Exception as e:
+                # drop only the session of peer, not server port.
+                _print_exception(e)
+                peer.close()
+                if peer.service_object:
+                    peer.service_object.on_exception(peer)
+
+    def _accept(self, port, service_object):
+        while True:
+            newport = None
+            try:
+                newport = port.accept()
+                if newport is None:
+                    return
+                new_service_object = service_object(port)
+                self.register(newport, new_service_object)
+                new_service_object.on_accepted(newport)
+            except Exception as e:
+                _print_exception(e)
+                if not newport:
+                    return		# accept() itself failed (e.g. EMFILE), don't spin
+                self.unregister(newport)
+                newport.close()
+            if not self._poll.edge:
+                return
+
+    def _io(self, port, service_object, flag):
+        if port.socket is None:		# closed by former event of same batch
+            return
+        try:
+            if flag & mpoll.POLLOUT:
+                port.flush()
+            if flag & ~mpoll.POLLOUT:
+                if isinstance(port, UDPServerPort):
+                    self._udp_dispatch(port, service_object)
+                elif port._manager is None:		# UDP
+                    packer = port._packer
+                    for msg, addr in port.recv_from_ready(self._poll.edge):
+                        packer.recv_addr = addr		# reply to sender
+                        service_object.mipc_received(port, msg)
+                else:
+                    port._last_recv = time.monotonic()
+                    port._inq.extend(port.recv_ready(self._poll.edge))
+                    self._dispatch(port, service_object)
+                if port.eof:
+                    raise SocketClosed()
+        except Exception as e:
+            self._close(port, service_object, e)
 
     def loop(self):
         while True:
-            for fobj, flag in self._poll.ipoll():
-                fd = fobj.fileno()
-                port, service_object = self._ports[fd]
+            timeout = self._run_timers()
+            for (port, service_object), flag in self._poll.events(timeout):
                 if port.acceptable:
-                    newport = None
-                    try:
-                        newport = port.accept()
-                        service_object = service_object(port)
-                        self.register(newport, service_object)
-                        service_object.on_accepted(newport)
-                    except Exception as e:
-                        _print_exception(e)
-                        if newport:
-                            self.unregister(newport)
-                            newport.close()
+                    self._accept(port, service_object)
                 else:
-                    try:
-                        msg = port.recv()
-                        service_object.mipc_received(port, msg)
-                    except SocketClosed as e:
-                        self.unregister(port)
-                        service_object.on_disconnected(port)
-                        port.close()
-                    except Exception as e:
-                        _print_exception(e)
-                        self.unregister(port)
-                        service_object.on_exception(port)
-                        port.close()
+                    self._io(port, service_object, flag)
 
 manager = _ServiceManager()
+
+#----------------------------------------------------------------------------
+#                    Multi-process server (one loop per core)
+#----------------------------------------------------------------------------
+
+class WorkerSupervisor(object):
+    # Fork workers, each of which runs its own _ServiceManager loop in its
+    # main thread, and restart a worker when it dies.
+    #
+    # With SO_REUSEPORT every worker has own listening socket and kernel
+    # balances connections. Otherwise the listening socket is made before
+    # fork and shared by workers (accept of non-blocking socket returns
+    # nothing in workers losing the race).
+    #
+    # service_object is inherited by fork, so its state is per worker.
+
+    RESTART_ITV_S = 1.0
+
+    def __init__(self, addr, service_object, packer=None, workers=None,
+                 reuseport=None, backlog=socket.SOMAXCONN):
+        if isinstance(addr, int):
+            addr = ('0.0.0.0', addr)
+        if reuseport is None:
+            reuseport = hasattr(socket, 'SO_REUSEPORT') and addr[1] != 0
+        self._addr = addr
+        self._service_object = service_object
+        self._packer = packer
+        self._workers = workers if workers else os.cpu_count()
+        self._reuseport = reuseport
+        self._backlog = backlog
+        self._port = None
+        self._pids = {}			# slot -> pid
+        self._lock = _thread_getlock()
+        self._running = False
+
+    @property
+    def pids(self):
+        return list(self._pids.values())
+
+    def _worker_main(self):
+        mgr = _ServiceManager(start=False)
+        if self._port:
+            mgr.register(self._port, self._service_object)
+        else:
+            mgr.register_server(self._addr, self._service_object,
+                                packer=self._packer, backlog=self._backlog,
+                                reuseport=True)
+        mgr.loop()
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._worker_main()
+                status = 0
+            except BaseException as e:
+                _print_exception(e)
+            finally:
+                os._exit(status)
+        self._pids[slot] = pid
+        return pid
+
+    def _watch(self, slot):
+        while True:
+            pid = self._pids[slot]
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            time.sleep(self.RESTART_ITV_S)
+            with self._lock:
+                if not self._running:
+                    return
+                self._spawn(slot)
+
+    def start(self):
+        if not self._reuseport:
+            self._port = AcceptablePort(self._addr, packer=self._packer,
+                                        backlog=self._backlog)
+            self._port.socket.setblocking(False)
+        self._running = True
+        with self._lock:
+            for slot in range(self._workers):
+                self._spawn(slot)
+        for slot in range(self._workers):
+            _thread_start(self._watch, (slot,))
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            for pid in self._pids.values():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        if self._port:
+            self._port.close()
+            self._port = None
+
+def fork_server(addr, service_object, packer=None, workers=None):
+    return WorkerSupervisor(addr, service_object, packer=packer,
+                            workers=workers).start()
@@ -4,33 +4,153 @@ import select
 
 if hasattr(select, 'epoll'):
 
+    import collections
+    import os
+    import threading
+    import traceback
+
     POLLIN = select.EPOLLIN
     POLLOUT = select.EPOLLOUT
     POLLERR = select.EPOLLERR
     POLLHUP = select.EPOLLHUP
 
     class poll(object):
-        def __init__(self):
+        # edge:      edge-triggered. Caller must read/write/accept until
+        #            EAGAIN for each event.
+        # maxevents: maximum number of events returned by one epoll_wait.
+        #
+        # register/modify can attach any object as data, and ipoll/events
+        # return it instead of fobj, so that caller needs no lookup of
+        # its own table by fileno.
+        #
+        # While some thread is in ipoll/events, register/unregister/modify
+        # from other threads are passed to that thread by call_soon, so
+        # that fd table is changed only by polling thread. call_soon wakes
+        # polling thread up by eventfd (or pipe if eventfd is unavailable).
+        # Deferred unregister/modify act only if fd is still registered by
+        # same fobj, since fd number may be reused by another object which
+        # is registered by polling thread in the meantime.
+
+        def __init__(self, edge=False, maxevents=-1):
             self._fobjs = {}
+            self._files = {}		# fd -> fobj registered
             self._poll = select.epoll()
-
-        def register(self, fobj, eventmask):
-            fd = fobj.fileno()
-            self._fobjs[fd] = fobj
-            self._poll.register(fd, eventmask)
+            self.edge = bool(edge)
+            self._et = select.EPOLLET if edge else 0
+            self._maxevents = maxevents
+            self._owner = None		# ident of polling thread
+            self._c_lock = threading.Lock()
+            self._calls = collections.deque()
+            self._notified = False
+            if hasattr(os, 'eventfd'):
+                self._wake_rfd = self._wake_wfd = os.eventfd(
+                    0, os.EFD_NONBLOCK|os.EFD_CLOEXEC)
+            else:
+                self._wake_rfd, self._wake_wfd = os.pipe()
+                os.set_blocking(self._wake_rfd, False)
+                os.set_blocking(self._wake_wfd, False)
+            self._poll.register(self._wake_rfd, select.EPOLLIN)
+
+        def _is_foreign(self):
+            owner = self._owner
+            return owner is not None and owner != threading.get_ident()
+
+        # fd table
+
+        def _register(self, fd, fobj, data, eventmask):
+            self._poll.register(fd, eventmask|self._et)
+            self._fobjs[fd] = data
+            self._files[fd] = fobj
+
+        def _unregister(self, fd, fobj):
+            if self._files.get(fd) is fobj:
+                del self._fobjs[fd]
+                del self._files[fd]
+                try:
+                    self._poll.unregister(fd)
+                except OSError:
+                    pass	# already closed (deferred unregister)
+
+        def _modify(self, fd, fobj, eventmask):
+            if self._files.get(fd) is fobj:
+                self._poll.modify(fd, eventmask|self._et)
+
+        def register(self, fobj, eventmask, data=None):
+            args = (fobj.fileno(), fobj, fobj if data is None else data,
+                    eventmask)
+            if self._is_foreign():
+                self.call_soon(self._register, *args)
+            else:
+                self._register(*args)
 
         def unregister(self, fobj):
-            fd = fobj.fileno()
-            if fd in self._fobjs:
-                del self._fobjs[fd]
-                self._poll.unregister(fd)
+            if self._is_foreign():
+                self.call_soon(self._unregister, fobj.fileno(), fobj)
+            else:
+                self._unregister(fobj.fileno(), fobj)
+
+        def modify(self, fobj, eventmask):
+            if self._is_foreign():
+                self.call_soon(self._modify, fobj.fileno(), fobj, eventmask)
+            else:
+                self._modify(fobj.fileno(), fobj, eventmask)
+
+        # wakeup
+
+        def call_soon(self, func, *args):
+            # thread safe: func is called by polling thread.
+            with self._c_lock:
+                self._calls.append((func, args))
+                if self._notified:
+                    return
+                self._notified = True
+            try:
+                if self._wake_rfd == self._wake_wfd:
+                    os.eventfd_write(self._wake_wfd, 1)
+                else:
+                    os.write(self._wake_wfd, b'\0')
+            except BlockingIOError:
+                pass
+
+        def _run_calls(self):
+            try:
+                os.read(self._wake_rfd, 8 if self._wake_rfd == self._wake_wfd else 4096)
+            except BlockingIOError:
+                pass
+            with self._c_lock:
+                self._notified = False
+                calls, self._calls = self._calls, collections.deque()
+            for func, args in calls:
+                try:
+                    func(*args)
+                except Exception:
+                    traceback.print_exc()
+
+        # polling
+
+        def _wait(self, timeout):
+            self._owner = threading.get_ident()
+            if self._calls:
+                timeout = 0
+            fds = self._poll.poll(timeout, self._maxevents)
+            if self._calls or any(fd == self._wake_rfd for fd, _ in fds):
+                self._run_calls()
+            return fds
 
         def ipoll(self, timeout=-1):
-            fds = self._poll.poll(timeout)
+            fds = self._wait(timeout)
             if timeout and not fds:
                 return
             for fd, flag in fds:
-                yield (self._fobjs[fd], flag)
+                data = self._fobjs.get(fd)
+                if data is not None:
+                    yield (data, flag)
+
+        def events(self, timeout=-1):
+            # batched version of ipoll: list of (data, flag).
+            fobjs = self._fobjs
+            fds = self._wait(timeout)
+            return [(fobjs[fd], flag) for fd, flag in fds if fd in fobjs]
 
         def poll(self, timeout=-1):
             return self._poll.poll(timeout)
@@ -41,12 +161,16 @@ else:
     import queue
 
     POLLIN = select.POLLIN
-    POLLOUT = select.POLLIN
+    POLLOUT = select.POLLOUT
     POLLERR = select.POLLERR|select.POLLNVAL
     POLLHUP = select.POLLHUP
 
     class poll(object):
-        def __init__(self):
+        # edge and maxevents are accepted for compatibility and ignored.
+        # (level-triggered poll also works with callers for edge mode)
+
+        def __init__(self, edge=False, maxevents=-1):
+            self.edge = False
             self._fobjs = {}
             self._poll = select.poll()
             self._notify_pipe = os.pipe()
@@ -63,16 +187,26 @@ else:
                 del self._fobjs[fd]
                 self._poll.unregister(fd)
 
-        def register(self, fobj, eventmask):
-            self._reqque.put((self._register, (fobj.fileno(), fobj, eventmask)))
+        def _modify(self, fd, eventmask):
+            if fd in self._fobjs:
+                self._poll.modify(fd, eventmask)
+
+        def register(self, fobj, eventmask, data=None):
+            data = fobj if data is None else data
+            self._reqque.put((self._register, (fobj.fileno(), data, eventmask)))
             os.write(self._notify_pipe[1], self._notify_data)
 
         def unregister(self, fobj):
             self._reqque.put((self._unregister, (fobj.fileno(),)))
             os.write(self._notify_pipe[1], self._notify_data)
 
+        def modify(self, fobj, eventmask):
+            self._reqque.put((self._modify, (fobj.fileno(), eventmask)))
+            os.write(self._notify_pipe[1], self._notify_data)
+
         def ipoll(self, timeout=-1):
-            fds = self._poll.poll(timeout)
+            # timeout is seconds as same as epoll version.
+            fds = self._poll.poll(timeout * 1000 if timeout >= 0 else None)
             if timeout and not fds:
                 return
             for fd, flag in fds:
@@ -86,5 +220,12 @@ else:
                     else:
                         print('fd:%1d is not registerd (maybe closed).' % fd)
 
+        def call_soon(self, func, *args):
+            self._reqque.put((func, args))
+            os.write(self._notify_pipe[1], self._notify_data)
+
+        def events(self, timeout=-1):
+            return list(self.ipoll(timeout))
+
         def poll(self, timeout=-1):
             return list(self.ipoll(timeout))
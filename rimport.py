@@ -10,6 +10,7 @@ import traceback
 from io import StringIO
 import tarfile
 from . import rpc
+from . import threadutil as tu
 from . import toolbox as tb
 
 ___ = tb.no_except
@@ -69,16 +70,16 @@ class PkgService(object):
                         es[pkgn] = pkgd
         return es
 
-    @rpc.export
+    @rpc.export(cache=rpc.ResultCache(maxsize=1, ttl_s=5))
     def get_exports(self):
         return list(self._get_exports().keys())
 
-    @rpc.export
+    @rpc.export(idempotent=True)
     def get_serial(self, pkgname):
         pkgd = self._get_exports().get(pkgname, None)
         return int(___(os.path.getmtime, 0)(pkgd))
 
-    @rpc.export
+    @rpc.export(idempotent=True, priority=tu.PRIORITY_LOW)
     def get_archive(self, pkgname):
         pkgd = self._get_exports().get(pkgname, None)
         return ___(archive, None)(pkgd)
@@ -125,7 +126,7 @@ class Finder(object):
                                   background=False, lazy_setup=False)
             if api:
                 for pkg in api.get_exports():
-                    self._svrcache[pkg] = tuple(addr)
+                    self._svrcache.setdefault(pkg, []).append(tuple(addr))
 
     def _get_cache(self):
         return tb.fn.eval(self._conf.get('CACHE', '~/.tpp/rimport/cache'))
@@ -157,11 +158,12 @@ class Finder(object):
 
     def _select_server(self, topname):
         tmo_s = self._get_tmo_s()
-        addr = self._svrcache.get(topname, None)
-        if addr is None:
+        addrs = self._svrcache.get(topname, None)
+        if addrs is None:
             return None
-        return  ___(rpc.client)(addr, itmo_s=0.05, ctmo_s=tmo_s,
-                                background=False, lazy_setup=False)
+        return  ___(rpc.balanced_client)(addrs, policy='failover',
+                                         itmo_s=0.05, ctmo_s=tmo_s,
+                                         background=False, lazy_setup=False)
 
     def _loadpkg_if(self, topname):
         cache = self._get_cache()
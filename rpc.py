@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import _pickle
+import collections
 import inspect
+import random
+import struct
+import time
+import weakref
 from . import ipc
 from . import toolbox as tb
 from . import threadutil as tu
@@ -10,6 +16,9 @@ from ctypes import Array as _C_ArrayType
 
 ___ = tb.no_except
 
+class Disconnected(ConnectionError):
+    pass
+
 #----------------------------------------------------------------------------
 #                            RPC main framework
 #----------------------------------------------------------------------------
@@ -18,11 +27,287 @@ _ATTR_EXPORT = '_RPC_EXPORT'
 _ATTR_QUICK  = '_RPC_QUICK'
 _ATTR_CIDARG = '_RPC_CIDARG'
 _ATTR_NOREPL = '_RPC_NOREPL'
+_ATTR_ORDER  = '_RPC_ORDER'
+_ATTR_CACHE  = '_RPC_CACHE'
+_ATTR_CCACHE = '_RPC_CCACHE'
+_ATTR_IDEMPO = '_RPC_IDEMPO'
+_ATTR_POOL   = '_RPC_POOL'
+_ATTR_PRIO   = '_RPC_PRIO'
+
+#----------------------------------------------------------------------------
+#                       Result cache for exported function
+#----------------------------------------------------------------------------
+
+_KEY_SCALAR = (str, int, float, bytes, bool, complex, type(None))
+
+def _canonical(v):
+    # hashable form of v which is equal for equal values: scalars are as
+    # is (so 1 and 1.0 are same key), containers are tagged by type and
+    # converted recursively, and any other object is pickled.
+    if isinstance(v, _KEY_SCALAR):
+        return v
+    if isinstance(v, (tuple, list)):
+        return (type(v).__name__, tuple([_canonical(x) for x in v]))
+    if isinstance(v, dict):
+        return ('dict', frozenset([(_canonical(k), _canonical(x))
+                                   for k, x in v.items()]))
+    if isinstance(v, (set, frozenset)):
+        return ('set', frozenset([_canonical(x) for x in v]))
+    return ('pickle', _pickle.dumps(v, ipc.PICKLE_PROTOCOL))
+
+class ResultCache(object):
+    # Cache of return values of an exported function which has no side
+    # effect. Entry is keyed by canonical form of arguments (_canonical),
+    # so equal arguments hit same entry and invalidate() drops it even if
+    # they are not same objects or types (e.g. 1 and 1.0). Objects other
+    # than builtin scalars and containers are compared by pickled bytes.
+    # Entry is evicted in LRU order
+    # when maxsize is exceeded, or dropped when it is older than ttl_s.
+    # generation is counted up by invalidate/clear, and put with the
+    # generation taken before the call is ignored if it has changed, so a
+    # result computed before invalidation is never stored.
+
+    def __new__(cls, maxsize=128, ttl_s=None):
+        self = super().__new__(cls)
+        self._lock = tu.Lock()
+        self._dic = collections.OrderedDict()	# key -> (expire, value)
+        self._maxsize = maxsize
+        self._ttl_s = ttl_s
+        self._c_hit = 0
+        self._c_miss = 0
+        self._c_evict = 0
+        self._c_expire = 0
+        self.generation = 0
+        self.on_invalidate = tb.Delegate()
+        return self
+
+    @staticmethod
+    def make_key(args, kwargs):
+        # return: key, or None if arguments are not picklable.
+        try:
+            return (tuple([_canonical(x) for x in args]),
+                    frozenset([(k, _canonical(x)) for k, x in kwargs.items()]))
+        except:
+            return None
+
+    def get(self, owner, key):
+        # return: (True, value) if cached, otherwise (False, None)
+        with self._lock:
+            ent = self._dic.get((owner, key))
+            if ent is not None:
+                if ent[0] is None or time.monotonic() < ent[0]:
+                    self._dic.move_to_end((owner, key))
+                    self._c_hit += 1
+                    return True, ent[1]
+                del self._dic[(owner, key)]
+                self._c_expire += 1
+            self._c_miss += 1
+            return False, None
+
+    def put(self, owner, key, value, generation=None):
+        expire = None
+        if self._ttl_s is not None:
+            expire = time.monotonic() + self._ttl_s
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return			# invalidated during the call
+            self._dic[(owner, key)] = (expire, value)
+            self._dic.move_to_end((owner, key))
+            while len(self._dic) > self._maxsize:
+                self._dic.popitem(last=False)
+                self._c_evict += 1
+
+    def invalidate(self, *args, **kwargs):
+        # drop entries called with args and kwargs.
+        key = self.make_key(args, kwargs)
+        with self._lock:
+            self.generation += 1
+            for k in [k for k in self._dic if k[1] == key]:
+                del self._dic[k]
+        self.on_invalidate(args, kwargs)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._dic.clear()
+        self.on_invalidate(None, None)
+
+    def stats(self):
+        with self._lock:
+            return tb.nameddict(size=len(self._dic),
+                                maxsize=self._maxsize,
+                                hits=self._c_hit,
+                                misses=self._c_miss,
+                                evictions=self._c_evict,
+                                expired=self._c_expire)
+
+    def reset_stats(self):
+        with self._lock:
+            self._c_hit = self._c_miss = self._c_evict = self._c_expire = 0
+
+def cache_of(func):
+    return getattr(func, _ATTR_CACHE, None)
+
+class _ProxyCache(object):
+    # Client side cache of results of functions exported with client_cache.
+    # Version of each function is counted up by invalidation from server,
+    # and a result is stored only if no invalidation arrived during the
+    # call, so a stale result never overwrites an invalidated entry.
+    # Result older than ttl_s is dropped, which bounds staleness when an
+    # invalidation is lost (e.g. sent while disconnected).
+
+    def __new__(cls, maxsize, ttl_s=None):
+        self = super().__new__(cls)
+        self._lock = tu.Lock()
+        self._dic = collections.OrderedDict()	# (name, key) -> (expire, value)
+        self._version = {}			# name -> version
+        self._maxsize = maxsize
+        self._ttl_s = ttl_s
+        return self
+
+    def get(self, name, key):
+        # return: (True, value) if cached, otherwise (False, version)
+        with self._lock:
+            ent = self._dic.get((name, key))
+            if ent is not None:
+                if ent[0] is None or time.monotonic() < ent[0]:
+                    self._dic.move_to_end((name, key))
+                    return True, ent[1]
+                del self._dic[(name, key)]
+            return False, self._version.get(name, 0)
+
+    def put(self, name, key, version, value):
+        expire = None
+        if self._ttl_s is not None:
+            expire = time.monotonic() + self._ttl_s
+        with self._lock:
+            if self._version.get(name, 0) != version:
+                return
+            self._dic[(name, key)] = (expire, value)
+            while len(self._dic) > self._maxsize:
+                self._dic.popitem(last=False)
+
+    def invalidate(self, name, key=None):
+        # key is None: all results of the function are dropped.
+        with self._lock:
+            self._version[name] = self._version.get(name, 0) + 1
+            if key is None:
+                for k in [k for k in self._dic if k[0] == name]:
+                    del self._dic[k]
+            else:
+                self._dic.pop((name, key), None)
+
+    def clear(self):
+        with self._lock:
+            for name in self._version:
+                self._version[name] += 1
+            self._dic.clear()
+
+def invalidate(func, *args, **kwargs):
+    # drop cached results of func called with args and kwargs, both of
+    # server side and client side.
+    cache = getattr(func, _ATTR_CACHE, None)
+    if cache is not None:
+        cache.invalidate(*args, **kwargs)
+    notifier = getattr(func, _ATTR_CCACHE, None)
+    if notifier is not None:
+        notifier(ResultCache.make_key(args, kwargs))
+
+def invalidate_all(func):
+    # drop all cached results of func, both of server side and client side.
+    cache = getattr(func, _ATTR_CACHE, None)
+    if cache is not None:
+        cache.clear()
+    notifier = getattr(func, _ATTR_CCACHE, None)
+    if notifier is not None:
+        notifier(None)
+
+#----------------------------------------------------------------------------
+#                          Compact wire format
+#----------------------------------------------------------------------------
+
+class RpcPacker(ipc.PyPacker):
+    # After negotiation at 'register', 'call', 'reply' and 'unref' messages
+    # are sent as struct-packed header followed by pickled arguments only.
+    # Any other message is pickled as before. Both formats are always
+    # accepted by unpack, so compact is only a choice of sending side.
+    #
+    #   call:   <B op><I reply_id><I proxy_id> + pickle(args[, kwargs])
+    #   reply:  <B op><I reply_id> + pickle(value/exception)
+    #   unref:  <B op><I proxy_id>
+    #
+    # op never collides with first byte of pickle (PROTO opcode: 0x80).
+    # Message having an id out of 32bit range is pickled as before.
+
+    _OP_CALL   = 1		# without kwargs
+    _OP_CALLKW = 2
+    _OP_RET    = 3
+    _OP_EXC    = 4
+    _OP_UNREF  = 5
+
+    _ID_MAX = 0xffffffff
+
+    _hdr_call = struct.Struct('<BII')
+    _hdr_one  = struct.Struct('<BI')
+
+    def __new__(cls):
+        self = super().__new__(cls)
+        self.compact = False
+        return self
+
+    @staticmethod
+    def _frame(s):
+        n = len(s)
+        return struct.pack('<i', n)+s, n+4
+
+    def pack(self, msg):
+        if not self.compact:
+            return super().pack(msg)
+        ev = msg[0]
+        if ev == 'call':
+            _, reply_id, proxy_id, args, kwargs = msg
+            if reply_id <= self._ID_MAX and proxy_id <= self._ID_MAX:
+                if kwargs:
+                    op, v = self._OP_CALLKW, (args, kwargs)
+                else:
+                    op, v = self._OP_CALL, args
+                return self._frame(self._hdr_call.pack(op, reply_id, proxy_id) +
+                                   _pickle.dumps(v, ipc.PICKLE_PROTOCOL))
+        elif ev == 'reply':
+            _, reply_id, success, value = msg
+            if reply_id <= self._ID_MAX:
+                op = self._OP_RET if success else self._OP_EXC
+                return self._frame(self._hdr_one.pack(op, reply_id) +
+                                   _pickle.dumps(value, ipc.PICKLE_PROTOCOL))
+        elif ev == 'unref':
+            if msg[1] <= self._ID_MAX:
+                return self._frame(self._hdr_one.pack(self._OP_UNREF, msg[1]))
+        return super().pack(msg)
+
+    def unpack(self, csock):
+        s = self.recv_frame(csock)
+        op = s[0]
+        if op == self._OP_CALL or op == self._OP_CALLKW:
+            _, reply_id, proxy_id = self._hdr_call.unpack_from(s)
+            v = _pickle.loads(memoryview(s)[self._hdr_call.size:])
+            if op == self._OP_CALL:
+                return ['call', reply_id, proxy_id, v, {}]
+            return ['call', reply_id, proxy_id, v[0], v[1]]
+        if op == self._OP_RET or op == self._OP_EXC:
+            _, reply_id = self._hdr_one.unpack_from(s)
+            v = _pickle.loads(memoryview(s)[self._hdr_one.size:])
+            return ['reply', reply_id, op == self._OP_RET, v]
+        if op == self._OP_UNREF:
+            _, proxy_id = self._hdr_one.unpack_from(s)
+            return ['unref', proxy_id]
+        return _pickle.loads(s)
 
 class _ProxyFrontend(object):
     __slots__ = ['_proxy_id', '_port', '_no_reply', '__name__', '__doc__']
     _mbox = tb.OnetimeMsgBox()
     _ign_in_del = (tu.Queue.AlreadyStopped,)
+    _p_lock = tu.Lock()
+    _pending = weakref.WeakKeyDictionary()	# port -> set of reply_id / None
 
     def __new__(cls, port, proxy_backend_id, no_reply):
         self = super().__new__(cls)
@@ -37,12 +322,25 @@ class _ProxyFrontend(object):
             reply_id = 0
         else:
             reply_id = self._mbox.reserve()
-        msg = ['call', reply_id, self._proxy_id, args, kwargs]
-        msg = _ProxyBackendManager.encode(port, msg)
-        port.send(msg)
+            self._add_pending(port, reply_id)
+        try:
+            msg = ['call', reply_id, self._proxy_id, args, kwargs]
+            msg = _ProxyBackendManager.encode(port, msg)
+            port.send(msg)
+        except:
+            if reply_id:
+                self._remove_pending(port, reply_id)
+                self._mbox.cancel(reply_id)
+            raise
         if self._no_reply:
             return
-        msg = self._mbox.wait(reply_id)
+        try:
+            msg = self._mbox.wait(reply_id)
+        except:
+            self._mbox.cancel(reply_id)		# e.g. threadutil.Canceled
+            raise
+        finally:
+            self._remove_pending(port, reply_id)
         if msg[2]:
             return _ProxyBackendManager.decode(port, msg[3])
         else:
@@ -57,8 +355,41 @@ class _ProxyFrontend(object):
     @classmethod
     def reply(cls, msg):
         # msg: ['reply', reply_id, True/False, value/exception]
+        if not msg[2]:
+            # raised by remote function, not by transport (see abort).
+            try:
+                msg[3]._rpc_remote = True
+            except AttributeError:
+                pass
         cls._mbox.post(msg[1], msg)
 
+    @classmethod
+    def _add_pending(cls, port, reply_id):
+        with cls._p_lock:
+            pending = cls._pending.setdefault(port, set())
+            if pending is None:
+                cls._mbox.cancel(reply_id)
+                raise Disconnected('Connection is already lost: %s' % port)
+            pending.add(reply_id)
+
+    @classmethod
+    def _remove_pending(cls, port, reply_id):
+        with cls._p_lock:
+            pending = cls._pending.get(port)
+            if pending:
+                pending.discard(reply_id)
+
+    @classmethod
+    def abort(cls, port):
+        # Waiting calls through the port never get a reply, so they are
+        # finished with Disconnected. None in _pending makes new calls fail.
+        with cls._p_lock:
+            pending = cls._pending.get(port)
+            cls._pending[port] = None
+        exc = Disconnected('Connection is lost: %s' % port)
+        for reply_id in (pending or ()):
+            cls._mbox.post(reply_id, ['reply', reply_id, False, exc])
+
     def __del__(self):
         try:
             self._port.send(['unref', self._proxy_id])
@@ -87,6 +418,7 @@ class _ProxyBackendManager(object):
     _lock = tu.Lock()
     _proxy_id = 0
     _proxy_db = {}
+    _serial_db = {}		# port.order -> {order_key: SerialQueue}
 
     @classmethod
     def _register(cls, func):
@@ -128,18 +460,44 @@ class _ProxyBackendManager(object):
     @classmethod
     def _call(cls, port, reply_id, func, args, kwargs):
         try:
-            args = cls.decode(port, args)
-            kwargs = cls.decode(port, kwargs)
-            if hasattr(func, _ATTR_CIDARG):
-                ret = func(port.order, *args, **kwargs)
+            cache = getattr(func, _ATTR_CACHE, None)
+            if cache is not None:
+                ret = cls._invoke_cached(cache, port, func, args, kwargs)
             else:
-                ret = func(*args, **kwargs)
+                ret = cls._invoke(port, func, args, kwargs)
             if reply_id:
                 port.send(['reply', reply_id, True, cls.encode(port, ret)])
         except Exception as e:
             if reply_id:
                 port.send(['reply', reply_id, False, e])
 
+    @classmethod
+    def _invoke(cls, port, func, args, kwargs):
+        args = cls.decode(port, args)
+        kwargs = cls.decode(port, kwargs)
+        if hasattr(func, _ATTR_CIDARG):
+            return func(port.order, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    @classmethod
+    def _invoke_cached(cls, cache, port, func, args, kwargs):
+        # Key is made from arguments before decoding, so callback proxies
+        # in arguments never hit. The owner of a bound method is a part of
+        # key because one function object is shared by all instances.
+        key = cache.make_key(args, kwargs)
+        owner = id(getattr(func, '__self__', None))
+        if hasattr(func, _ATTR_CIDARG):
+            owner = (owner, port.order)
+        if key is not None:
+            hit, ret = cache.get(owner, key)
+            if hit:
+                return ret
+        generation = cache.generation
+        ret = cls._invoke(port, func, args, kwargs)
+        if key is not None:
+            cache.put(owner, key, ret, generation)
+        return ret
+
     @classmethod
     def call(cls, port, reply_id, proxy_id, args, kwargs):
         try:
@@ -147,12 +505,54 @@ class _ProxyBackendManager(object):
                 func = cls._proxy_db[proxy_id]
             if hasattr(func, _ATTR_QUICK):
                 cls._call(port, reply_id, func, args, kwargs)
+            elif hasattr(func, _ATTR_ORDER):
+                sq = cls._serial_queue(port, getattr(func, _ATTR_ORDER))
+                sq.queue(cls._call, port, reply_id, func, args, kwargs)
+            elif hasattr(func, _ATTR_POOL):
+                cls._call_on_pool(getattr(func, _ATTR_POOL),
+                                  port, reply_id, func, args, kwargs)
+            elif hasattr(func, _ATTR_PRIO):
+                tu.threadpool.queue_task(cls._call,
+                                         (port, reply_id, func, args, kwargs),
+                                         priority=getattr(func, _ATTR_PRIO))
             else:
                 tu.threadpool.queue(cls._call, port, reply_id, func, args, kwargs)
         except Exception as e:
             if reply_id:
                 port.send(['reply', reply_id, False, e])
 
+    @classmethod
+    def _call_on_pool(cls, pool, port, reply_id, func, args, kwargs):
+        if not hasattr(pool, 'queue_with_result'):
+            pool.queue(cls._call, port, reply_id, func, args, kwargs)
+            return
+        # Pool of other processes: only func and arguments are passed to
+        # it, and result is sent back by callback in this process.
+        args = cls.decode(port, args)
+        kwargs = cls.decode(port, kwargs)
+        if hasattr(func, _ATTR_CIDARG):
+            args = [port.order] + list(args)
+        def on_done(success, value):
+            if reply_id:
+                if success:
+                    value = cls.encode(port, value)
+                port.send(['reply', reply_id, success, value])
+        pool.queue_with_result(on_done, func, *args, **kwargs)
+
+    @classmethod
+    def _serial_queue(cls, port, order_key):
+        with cls._lock:
+            sqs = cls._serial_db.setdefault(port.order, {})
+            sq = sqs.get(order_key)
+            if sq is None:
+                sq = sqs[order_key] = tu.SerialQueue()
+            return sq
+
+    @classmethod
+    def release(cls, port):
+        with cls._lock:
+            cls._serial_db.pop(port.order, None)
+
     @classmethod
     def get(cls, proxy_id):
         with cls._lock:
@@ -176,11 +576,25 @@ class _RpcCommon(ipc.ServiceBase):
         # msg: ['unref', proxy_id]
         _ProxyBackendManager.unref(msg[1])
 
-    def handle_DISCONNECTED(self, port):
+    def handle_invalidate(self, port, msg):
+        # msg: ['invalidate', name, key/None]
+        self.invalidate_cache(msg[1], msg[2])
+
+    def invalidate_cache(self, name, key):
         pass
 
+    def handle_compact(self, port, msg):
+        # msg: ['compact']
+        if isinstance(port.packer, RpcPacker):
+            port.packer.compact = True
+
+    def handle_DISCONNECTED(self, port):
+        _ProxyBackendManager.release(port)
+        _ProxyFrontend.abort(port)
+
     def handle_SOCKERROR(self, port):
-        pass
+        _ProxyBackendManager.release(port)
+        _ProxyFrontend.abort(port)
 
 class _RpcServer(_RpcCommon):
     def __new__(cls, *args, **kwargs):
@@ -189,6 +603,8 @@ class _RpcServer(_RpcCommon):
         self._on_connection = tb.Delegate()
         self._on_disconnection = tb.Delegate()
         self._cids = set([])
+        self._cacheable = []
+        self._idempotent = []
         return self
 
     @classmethod
@@ -203,6 +619,40 @@ class _RpcServer(_RpcCommon):
             v = kwargs.pop('no_reply', False)
             if v:
                 setattr(func, _ATTR_NOREPL, True)
+            v = kwargs.pop('ordered', False)
+            if v:
+                # ordered=True: serialized with other ordered calls of
+                #               same connection.
+                # ordered=KEY:  serialized with calls having same KEY
+                #               of same connection.
+                setattr(func, _ATTR_ORDER, v)
+            v = kwargs.pop('cache', None)
+            if v:
+                # cache=True:  cached by default ResultCache.
+                # cache=OBJ:   cached by OBJ (instance of ResultCache).
+                if not isinstance(v, ResultCache):
+                    v = ResultCache()
+                setattr(func, _ATTR_CACHE, v)
+            v = kwargs.pop('client_cache', False)
+            if v:
+                # results may be cached by client, and cached results are
+                # dropped by rpc.invalidate/rpc.invalidate_all.
+                setattr(func, _ATTR_CCACHE, tb.Delegate())
+            v = kwargs.pop('pool', None)
+            if v is not None:
+                # pool=POOL: called on POOL instead of threadutil.threadpool.
+                #            On threadutil.ProcessPool, func and arguments
+                #            must be picklable and cache is not applied.
+                setattr(func, _ATTR_POOL, v)
+            v = kwargs.pop('priority', None)
+            if v is not None:
+                # priority=threadutil.PRIORITY_HIGH/LOW: queued to
+                #          threadutil.threadpool with the priority.
+                setattr(func, _ATTR_PRIO, v)
+            v = kwargs.pop('idempotent', False)
+            if v:
+                # balanced client may call it again on another server.
+                setattr(func, _ATTR_IDEMPO, True)
             if kwargs:
                 raise TypeError('unknown keyword arguments: %s' % kwargs)
             setattr(func, _ATTR_EXPORT, True)
@@ -225,18 +675,35 @@ class _RpcServer(_RpcCommon):
                 if v.__doc__:
                     doc = '%s\n \n%s' % (doc, v.__doc__)
                 self._exports.append((cnv(v), v.__name__, doc))
+                if (hasattr(v, _ATTR_IDEMPO) or hasattr(v, _ATTR_CACHE) or
+                    hasattr(v, _ATTR_CCACHE)):
+                    self._idempotent.append(v.__name__)
+                if hasattr(v, _ATTR_CCACHE):
+                    self._cacheable.append(v.__name__)
+                    notifier = getattr(v, _ATTR_CCACHE)
+                    notifier += self._invalidate_notifier(v.__name__)
         if hasattr(rpcitf, 'on_connection'):
             self._on_connection += rpcitf.on_connection
         if hasattr(rpcitf, 'on_disconnection'):
             self._on_disconnection += rpcitf.on_disconnection
         return self
 
+    def _invalidate_notifier(self, name):
+        def notify(key):
+            self.sendto_all(['invalidate', name, key])
+        return notify
+
     def handle_ACCEPTED(self, port):
-        port.send(['register', self._exports])
+        # 3rd element is ignored by old clients.
+        options = {'cacheable': self._cacheable,
+                   'idempotent': self._idempotent,
+                   'compact': isinstance(port.packer, RpcPacker)}
+        port.send(['register', self._exports, options])
         self._cids.add(port.order)
         self._on_connection(port.order)
 
     def handle_DISCONNECTED(self, port):
+        super().handle_DISCONNECTED(port)
         if port.order in self._cids:
             self._cids.remove(port.order)
             self._on_disconnection(port.order)
@@ -245,33 +712,69 @@ class _RpcServer(_RpcCommon):
         return self.handle_DISCONNECTED(port)
 
 class _RpcClient(_RpcCommon):
-    def __new__(cls, itmo_s, *args, **kwargs):
+    def __new__(cls, itmo_s, cache_size=0, cache_ttl_s=None, *args, **kwargs):
         self = super().__new__(cls)
         self._proxy = None
         self._proxy_cond = tu.Condition()
         self._port = None
         self._itmo_s = itmo_s
+        self._cache = (_ProxyCache(cache_size, cache_ttl_s)
+                       if cache_size else None)
+        self.idempotent = frozenset()
         return self
 
-    def _create_proxy(self, frontend, name, doc):
+    def _create_proxy(self, frontend, name, doc, cacheable=False):
         def _proxy_function(*args, **kwargs):
             return frontend(*args, **kwargs)
+        def _cached_proxy_function(*args, **kwargs):
+            # cached value is shared, so caller must not modify it.
+            key = ResultCache.make_key(args, kwargs)
+            if key is None:
+                return frontend(*args, **kwargs)
+            hit, v = cache.get(name, key)
+            if hit:
+                return v
+            ret = frontend(*args, **kwargs)
+            cache.put(name, key, v, ret)
+            return ret
+        cache = self._cache
+        if cache is not None and cacheable:
+            _proxy_function = _cached_proxy_function
         _proxy_function.__name__ = name
         _proxy_function.__doc__ = doc
         return _proxy_function
 
     def handle_register(self, port, msg):
-        # msg: ['register', [(func, name, doc) ...]]
+        # msg: ['register', [(func, name, doc) ...], {options}]
         self._port = port
+        options = msg[2] if len(msg) > 2 else {}
+        cacheable = set(options.get('cacheable', ()))
+        self.idempotent = frozenset(options.get('idempotent', ()))
+        if options.get('compact') and isinstance(port.packer, RpcPacker):
+            port.packer.compact = True
+            port.send(['compact'])
         class Proxies(object):
             pass
         proxy = Proxies()
         for f, n, d in _ProxyBackendManager.decode(port, msg[1]):
-            setattr(proxy, n, self._create_proxy(f, n, d))
+            setattr(proxy, n, self._create_proxy(f, n, d, n in cacheable))
         with self._proxy_cond:
             self._proxy = proxy
             self._proxy_cond.notify_all()
 
+    def invalidate_cache(self, name, key):
+        if self._cache is not None:
+            self._cache.invalidate(name, key)
+
+    def handle_DISCONNECTED(self, port):
+        super().handle_DISCONNECTED(port)
+        self._port = None
+        if self._cache is not None:
+            self._cache.clear()
+
+    def handle_SOCKERROR(self, port):
+        return self.handle_DISCONNECTED(port)
+
     def stop(self):
         if self._port:
             self._port.send_fin()
@@ -281,9 +784,10 @@ class _RpcClient(_RpcCommon):
 
     @property
     def proxy(self):
+        deadline = tu.Deadline(self._itmo_s or None)	# 0: no timeout
         with self._proxy_cond:
             while self._proxy is None:
-                if not self._proxy_cond.wait(self._itmo_s):
+                if not self._proxy_cond.wait(deadline):
                     return None
             return self._proxy
 
@@ -301,24 +805,33 @@ def server(addr, funcs_list, background=True, thread_max=0, thread_lwm=0):
     svc = _RpcServer()
     for funcs in funcs_list:
         svc.exports(funcs)
-    ipc.Acceptor(svc, addr).start(background)
+    ipc.Acceptor(svc, addr, packer_factory=RpcPacker).start(background)
 
 class client(object):
     _is_running = tu.is_running
 
     def __new__(cls, addr,
-                itmo_s=2.0, ctmo_s=None, background=True, lazy_setup=True):
+                itmo_s=2.0, ctmo_s=None, background=True, lazy_setup=True,
+                cache_size=0, cache_ttl_s=None):
+        if isinstance(addr, list):
+            return balanced_client(addr, itmo_s=itmo_s, ctmo_s=ctmo_s,
+                                   background=background,
+                                   lazy_setup=lazy_setup,
+                                   cache_size=cache_size,
+                                   cache_ttl_s=cache_ttl_s)
         self = super().__new__(cls)
-        self._prm = (addr, itmo_s, ctmo_s, background)
+        self._prm = (addr, itmo_s, ctmo_s, background, cache_size, cache_ttl_s)
         self._lock = tu.RLock()
         if not lazy_setup:
             self._setup()
         return self
     
     def _setup(self):
-        addr, itmo_s, ctmo_s, bg = self._prm
-        self._rc = _RpcClient(itmo_s=itmo_s)
-        ipc.Connector(self._rc, addr, retry=False, ctmo_s=ctmo_s).start(background=bg)
+        addr, itmo_s, ctmo_s, bg, cache_size, cache_ttl_s = self._prm
+        self._rc = _RpcClient(itmo_s=itmo_s, cache_size=cache_size,
+                              cache_ttl_s=cache_ttl_s)
+        ipc.Connector(self._rc, addr, retry=False, ctmo_s=ctmo_s,
+                      packer=RpcPacker()).start(background=bg)
 
     def __getattr__(self, name):
         with self._lock:
@@ -330,8 +843,234 @@ class client(object):
             return v
 
     def __del__(self):
-        if self._is_running() and self._rc:
-            self._rc.stop()
+        rc = self.__dict__.get('_rc')
+        if self._is_running() and rc:
+            rc.stop()
+
+#----------------------------------------------------------------------------
+#                  Load balancing client for multiple servers
+#----------------------------------------------------------------------------
+
+class _Member(object):
+    def __new__(cls, addr, prm):
+        self = super().__new__(cls)
+        self.addr = addr
+        self.client = None
+        self.outstanding = 0
+        self.latency_s = None		# EWMA of successful calls
+        self.down_until = 0.0
+        self._prm = prm
+        self._lock = tu.Lock()		# guards creation/drop of client
+        return self
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+    def proxy(self):
+        # return: proxy object of connected server
+        # exception: Disconnected
+        with self._lock:
+            c = self.client
+            if c is None:
+                itmo_s, ctmo_s, bg, cache_size, cache_ttl_s = self._prm
+                c = self.client = client(self.addr, itmo_s=itmo_s,
+                                         ctmo_s=ctmo_s, background=bg,
+                                         cache_size=cache_size,
+                                         cache_ttl_s=cache_ttl_s)
+        try:
+            rc = c._rc
+            proxy = rc.proxy
+        except Exception as e:
+            raise Disconnected('Cannot connect: %s' % (self.addr,)) from e
+        if proxy is None or rc._port is None:
+            raise Disconnected('Cannot connect: %s' % (self.addr,))
+        return proxy
+
+    def is_idempotent(self, name):
+        return self.client is not None and name in self.client._rc.idempotent
+
+    def down(self, retry_s):
+        self.down_until = time.monotonic() + retry_s
+        with self._lock:
+            c, self.client = self.client, None
+        if c is not None:
+            rc = c.__dict__.get('_rc')
+            if rc:
+                ___(rc.stop)()
+
+class balanced_client(object):
+    # Calls are distributed over servers of addrs by policy:
+    #
+    #   'round_robin':        each server in turn.
+    #   'least_outstanding':  server having fewest calls in progress.
+    #   'latency':            random, weighted by inverse of latency.
+    #   'failover':           first available server in order of addrs.
+    #
+    # Server failing on connection is skipped for retry_s seconds. Call
+    # failing by connection error is retried on another server only if it
+    # is exported as idempotent (or cacheable), or it was not sent yet.
+    # Exception raised by remote function (even OSError) is not connection
+    # error, and is raised as is.
+
+    POLICIES = ('round_robin', 'least_outstanding', 'latency', 'failover')
+    _conn_errors = (Disconnected, tu.Queue.AlreadyStopped, OSError)
+
+    def __new__(cls, addrs, policy='round_robin',
+                itmo_s=2.0, ctmo_s=None, background=True, lazy_setup=True,
+                cache_size=0, cache_ttl_s=None, retry_s=5.0,
+                health_itv_s=None):
+        if policy not in cls.POLICIES:
+            raise ValueError('Unknown policy: %s' % policy)
+        if not addrs:
+            raise ValueError('No server address is specified.')
+        self = super().__new__(cls)
+        prm = (itmo_s, ctmo_s, background, cache_size, cache_ttl_s)
+        self._members = [_Member(a, prm) for a in addrs]
+        self._lock = tu.RLock()
+        self._policy = getattr(self, '_pick_' + policy)
+        self._rr = 0
+        self._retry_s = retry_s
+        self._latency_alpha = 0.2
+        if not lazy_setup:
+            self.check()
+            if not [m for m in self._members if m.client is not None]:
+                raise Disconnected('Cannot connect to any server: %s' % addrs)
+        if health_itv_s:
+            t = tu.Thread(target=cls._health_thread,
+                          args=(weakref.ref(self), health_itv_s))
+            t.daemon = True
+            t.name = 'rpc.balanced_client(H)'
+            t.start()
+        return self
+
+    # server selection
+
+    def _pick_round_robin(self, ms):
+        self._rr += 1
+        return ms[self._rr % len(ms)]
+
+    def _pick_least_outstanding(self, ms):
+        self._rr += 1
+        n = len(ms)
+        ms = [ms[(self._rr + i) % n] for i in range(n)]
+        return min(ms, key=lambda m:m.outstanding)
+
+    def _pick_latency(self, ms):
+        known = [m.latency_s for m in ms if m.latency_s is not None]
+        if len(known) < len(ms):
+            # server which has never answered is tried first.
+            return self._pick_round_robin([m for m in ms if m.latency_s is None])
+        weights = [1.0 / max(m.latency_s, 1e-6) for m in ms]
+        return random.choices(ms, weights)[0]
+
+    def _pick_failover(self, ms):
+        return ms[0]
+
+    def _pick(self, tried):
+        now = time.monotonic()
+        with self._lock:
+            ms = [m for m in self._members if m not in tried and m.is_up(now)]
+            if not ms:
+                return None
+            m = self._policy(ms)
+            m.outstanding += 1
+            return m
+
+    # calling
+
+    def _call(self, name, args, kwargs):
+        tried = set()
+        error = None
+        while True:
+            m = self._pick(tried)
+            if m is None:
+                if error:
+                    raise error
+                raise Disconnected('No server is available: %s' %
+                                   [m.addr for m in self._members])
+            tried.add(m)
+            sent = False
+            try:
+                func = getattr(m.proxy(), name)
+                sent = True
+                t0 = time.monotonic()
+                ret = func(*args, **kwargs)
+            except self._conn_errors as e:
+                if getattr(e, '_rpc_remote', False):
+                    # raised by remote function: server is healthy.
+                    with self._lock:
+                        m.outstanding -= 1
+                    raise
+                # AlreadyStopped: message was not sent.
+                if isinstance(e, tu.Queue.AlreadyStopped):
+                    sent = False
+                retry = not sent or m.is_idempotent(name)
+                with self._lock:
+                    m.outstanding -= 1
+                    m.down(self._retry_s)
+                if not retry:
+                    raise
+                error = e
+                continue
+            except:
+                with self._lock:
+                    m.outstanding -= 1
+                raise
+            with self._lock:
+                m.outstanding -= 1
+                t = time.monotonic() - t0
+                if m.latency_s is None:
+                    m.latency_s = t
+                else:
+                    a = self._latency_alpha
+                    m.latency_s = (1 - a) * m.latency_s + a * t
+            return ret
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError(name)
+        def _proxy_function(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        _proxy_function.__name__ = name
+        self.__dict__[name] = _proxy_function
+        return _proxy_function
+
+    # health check
+
+    def check(self):
+        # try to connect servers which are not connected, and return list
+        # of addresses of available servers.
+        now = time.monotonic()
+        for m in self._members:
+            if m.client is None and not m.is_up(now):
+                continue
+            try:
+                m.proxy()
+                m.down_until = 0.0
+            except Disconnected:
+                with self._lock:
+                    m.down(self._retry_s)
+        return [m.addr for m in self._members if m.client is not None]
+
+    @staticmethod
+    def _health_thread(me, itv_s):
+        # me: weakref of client, so that thread stops when client is freed.
+        while True:
+            time.sleep(itv_s)
+            self = me()
+            if self is None:
+                return
+            self.check()
+            del self
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [tb.nameddict(addr=m.addr,
+                                 up=m.is_up(now),
+                                 outstanding=m.outstanding,
+                                 latency_s=m.latency_s)
+                    for m in self._members]
 
 #----------------------------------------------------------------------------
 #----------------------------------------------------------------------------
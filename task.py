@@ -118,7 +118,13 @@ class _TaskAction(_TaskBase):
                 if self.__cancel:
                     raise tu.Canceled()
                 self.__thread = tu.current_thread()
-            result = func(*args, **kwargs)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                with self._i_lock:
+                    # pool thread goes to other task, so don't cancel it
+                    self.__thread = None
+                    self.__cancel = True
             self._result.success = True
             self._result.result = result
         except Exception as e:
@@ -126,8 +132,27 @@ class _TaskAction(_TaskBase):
             self._result.traceback = sys.exc_info()[2]
         self._epilogue()
 
+    def __done(self, success, value):
+        # called back by pool reporting result (threadutil.ProcessPool).
+        self._result.success = success
+        self._result.result = value
+        if not success:
+            self._result.traceback = value.__traceback__
+        self._epilogue()
+
     def _start(self):
-        self.threadpool.queue(self.__action)
+        if not hasattr(self.threadpool, 'queue_with_result'):
+            self.threadpool.queue(self.__action)
+            return
+        func, args, kwargs = self.__act
+        with self._i_lock:
+            canceled = self.__cancel
+        try:
+            if canceled:
+                raise tu.Canceled()
+            self.threadpool.queue_with_result(self.__done, func, *args, **kwargs)
+        except Exception as e:
+            self.__done(False, e)
 
     def abort(self):
         with self._i_lock:
@@ -311,11 +336,21 @@ class DAGNode(object):
     def is_endpoint(self):
         return not bool(self._depended_by)
 
-    def do(self, dag):
+    def _is_ready(self):
         for n in self._depend_on:
             if n.status is not True:
-                break
-        else:
+                return False
+        return True
+
+    def _finish(self, dag):
+        with self._c_lock:
+            for n in self._depended_by:
+                n._depend_on_cd -= 1
+                if n._depend_on_cd == 0:
+                    dag.queue(n)
+
+    def do(self, dag):
+        if self._is_ready():
             try:
                 args = self.args if self.args else ()
                 kwargs = self.kwargs if self.kwargs else {}
@@ -325,11 +360,32 @@ class DAGNode(object):
                 traceback.print_exc()
                 self.status = False
                 dag.error(self)
-        with self._c_lock:
-            for n in self._depended_by:
-                n._depend_on_cd -= 1
-                if n._depend_on_cd == 0:
-                    dag.queue(n)
+        self._finish(dag)
+
+    def do_on(self, dag, pool):
+        # Run action on pool reporting result (threadutil.ProcessPool).
+        # action gets a copy of node detached from graph, so changes made
+        # to it by action are not reflected.
+        if not self._is_ready():
+            self._finish(dag)
+            return
+        def on_done(success, value):
+            if success:
+                self.status = True
+            else:
+                traceback.print_exception(type(value), value, value.__traceback__)
+                self.status = False
+                dag.error(self)
+            self._finish(dag)
+        node = DAGNode()
+        node.key = self.key
+        node.data = self.data
+        args = self.args if self.args else ()
+        kwargs = self.kwargs if self.kwargs else {}
+        try:
+            pool.queue_with_result(on_done, self.action, node, *args, **kwargs)
+        except Exception as e:
+            on_done(False, e)
             
 class DAGTasks(object):
     def __new__(cls):
@@ -382,11 +438,13 @@ class DAGTasks(object):
                 self._root.depend_on(n)
         for n in self._nodes:
             if n.is_startpoint():
-                self._threadpool.queue(n.do, self)
+                self.queue(n)
 
     def queue(self, node):
         if node is self._root:
             self._threadpool.end(soon=True)
+        elif hasattr(self._threadpool, 'queue_with_result'):
+            node.do_on(self, self._threadpool)
         else:
             self._threadpool.queue(node.do, self)
 
@@ -1,26 +1,31 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import concurrent.futures
 import functools
+import os
 import threading
 import time
 import traceback
+import weakref
 from threading import *
 from . import toolbox as tb
 
 pr = tb.pr			# for compatibility
+Deadline = tb.Deadline
 
 #-----------------------------------------------------------------------------
 #                 Extend class to avoid blocking main thread
 #-----------------------------------------------------------------------------
 
-_tmo_s = 3600*24*365*100
-
 # canceling tool
 
 class Canceled(Exception):
     pass
 
+class DeadlineExceeded(TimeoutError):
+    pass
+
 def test_cancel(cleaner=None):
     t = threading.current_thread()
     if t._canceling.is_set():
@@ -28,6 +33,57 @@ def test_cancel(cleaner=None):
             cleaner()
         raise Canceled()
 
+# Blocking waits register a waker by cancel_scope while blocking, and
+# Thread.cancel calls it to interrupt them. Waits of threads other than
+# Thread (e.g. main thread), or of Thread whose cancelable is False, are
+# not cancelable.
+
+class _CancelScope(object):
+    def __init__(self, thread, waker):
+        self._thread = thread
+        self._waker = waker
+
+    def __enter__(self):
+        self._thread._add_waker(self._waker)
+        if self._thread._canceling.is_set():
+            self._thread._remove_waker(self._waker)
+            raise Canceled()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._thread._remove_waker(self._waker)
+
+    def check(self):
+        if self._thread._canceling.is_set():
+            raise Canceled()
+
+class _NoCancelScope(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def check(self):
+        pass
+
+_no_cancel_scope = _NoCancelScope()
+
+def cancel_scope(waker, cancelable=True):
+    # with cancel_scope(waker) as scope: waker() is called if current
+    # thread is canceled in this block, and scope.check() raises Canceled
+    # if canceled. Canceled is raised also at entering if already canceled.
+    t = threading.current_thread()
+    if cancelable and getattr(t, 'cancelable', False):
+        return _CancelScope(t, waker)
+    return _no_cancel_scope
+
+def cancel_fd():
+    # return: fd which becomes readable when current thread is canceled
+    #         (to be waited with sockets by select), or None.
+    t = threading.current_thread()
+    return t.cancel_fd() if getattr(t, 'cancelable', False) else None
+
 # make daemon thread to finish sliently in interpter shutdown
 
 def quiet_finalize():
@@ -79,41 +135,130 @@ class Thread(threading.Thread):
         kwargs['target'] = quiet_finalize(kwargs['target'])
         super().__init__(**kwargs)
         self._canceling = threading.Event()
+        self.cancelable = True		# False for threads never canceled
+        self._w_lock = threading.Lock()
+        self._wakers = []
+        self._cancel_fd = None
 
     def join(self, timeout=None):
-        tmo_s = timeout if timeout else _tmo_s
-        while self.is_alive():
-            super().join(tmo_s)
-            if timeout:
-                break
+        # timeout: seconds, Deadline or None (no timeout)
+        super().join(Deadline.of(timeout).remaining())
         return not self.is_alive()
 
     def cancel(self):
-        self._canceling.set()
+        with self._w_lock:
+            self._canceling.set()
+            wakers = list(self._wakers)
+            if self._cancel_fd is not None:
+                self._signal_fd()
+        for waker in wakers:
+            try:
+                waker()
+            except:
+                traceback.print_exc()
 
     def clear_cancel(self):
-        self._canceling.clear()
+        with self._w_lock:
+            if self._canceling.is_set() and self._cancel_fd is not None:
+                try:
+                    os.read(self._cancel_fd[0], 4096)
+                except BlockingIOError:
+                    pass
+            self._canceling.clear()
+
+    def cancel_scope(self, waker):
+        return _CancelScope(self, waker)
+
+    def cancel_fd(self):
+        # fd readable while canceled (eventfd, or pipe if unavailable),
+        # created at first call and kept until the thread object is freed.
+        with self._w_lock:
+            if self._cancel_fd is None:
+                if hasattr(os, 'eventfd'):
+                    fd = os.eventfd(0, os.EFD_NONBLOCK|os.EFD_CLOEXEC)
+                    self._cancel_fd = (fd, fd)
+                else:
+                    self._cancel_fd = os.pipe()
+                    os.set_blocking(self._cancel_fd[0], False)
+                    os.set_blocking(self._cancel_fd[1], False)
+                if self._canceling.is_set():
+                    self._signal_fd()
+            return self._cancel_fd[0]
+
+    def _signal_fd(self):
+        # require: self._w_lock must be locked by caller.
+        try:
+            os.write(self._cancel_fd[1], b'\1' * 8)
+        except BlockingIOError:
+            pass
+
+    def __del__(self):
+        fds = getattr(self, '_cancel_fd', None)
+        if fds is not None:
+            for fd in set(fds):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+    def _add_waker(self, waker):
+        with self._w_lock:
+            self._wakers.append(waker)
+
+    def _remove_waker(self, waker):
+        with self._w_lock:
+            self._wakers.remove(waker)
+
+# Waits below take timeout as seconds, Deadline or None (no timeout). A
+# Deadline passed to successive waits bounds them all together.
+#
+# [API CHANGE] timeout 0 now polls as threading does. Formerly 0 (any
+# false value) of Condition.wait, Event.wait, Thread.join and Queue.get
+# meant no timeout, so callers relying on it must pass None instead.
+# (ThreadPool/WorkStealingPool thread_tmo 0 still means no idle timeout.)
 
 class Condition(type(threading.Condition())):
-    def wait(self, timeout=None):
-        tmo_s = timeout if timeout else _tmo_s
-        lim_s = time.time() + tmo_s
-        while True:
-            super().wait(tmo_s)
-            if time.time() < lim_s:
-                return True
-            if timeout:
-                return False
+    # wait raises Canceled if the waiting Thread is canceled, unless
+    # cancelable is False.
+    def _cancel_waker(self):
+        with self:
+            self.notify_all()
+
+    def wait(self, timeout=None, cancelable=True):
+        # return: False if timeout.
+        deadline = Deadline.of(timeout)
+        with cancel_scope(self._cancel_waker, cancelable) as scope:
+            while True:
+                notified = super().wait(deadline.remaining())
+                scope.check()
+                if notified or deadline.expired:
+                    return notified
+
+    def wait_for(self, predicate, timeout=None, cancelable=True):
+        deadline = Deadline.of(timeout)
+        result = predicate()
+        while not result:
+            if deadline.expired:
+                break
+            self.wait(deadline, cancelable)
+            result = predicate()
+        return result
 
 class Event(type(threading.Event())):
-    def wait(self, timeout=None):
-        tmo_s = timeout if timeout else _tmo_s
-        while True:
-            super().wait(tmo_s)
-            if self.is_set():
-                return True
-            if timeout:
-                return False
+    def _cancel_waker(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, timeout=None, cancelable=True):
+        # return: False if timeout.
+        deadline = Deadline.of(timeout)
+        with cancel_scope(self._cancel_waker, cancelable) as scope:
+            while True:
+                if super().wait(deadline.remaining()):
+                    return True
+                scope.check()
+                if deadline.expired:
+                    return False
 
 #-----------------------------------------------------------------------------
 #                              Cancelable queue
@@ -140,10 +285,12 @@ class Queue(object):
             self._cond.notify_all()
             return self
 
-    def get(self, tmo_s = _tmo_s):
+    def get(self, tmo_s = None, cancelable=True):
+        # tmo_s: seconds, Deadline or None (no timeout)
+        deadline = Deadline.of(tmo_s)
         with self._cond:
             while not self._list:
-                if not self._cond.wait(tmo_s):
+                if not self._cond.wait(deadline, cancelable):
                     return self._value_in_tmo
             data = self._list.popleft()
             if data is self._value_in_stopped:
@@ -162,11 +309,587 @@ class Queue(object):
             self._list.clear()
             self._stopped = False
 
+class HandoffQueue(object):
+    # Same interface as Queue, but put wakes exactly one waiting getter
+    # per item instead of all of them. Each getter sleeps on its own lock
+    # (as threading.Condition does internally) and put releases the oldest
+    # one. Timeout is based on time.monotonic.
+    AlreadyStopped = Queue.AlreadyStopped
+
+    def __new__(cls, value_in_tmo = None, value_in_stopped = False):
+        self = super().__new__(cls)
+        self._list = collections.deque()
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self._value_in_tmo = value_in_tmo
+        self._value_in_stopped = value_in_stopped
+        self._stopped = False
+        return self
+
+    def _wake(self, n):
+        # require: self._lock must be locked by caller.
+        waiters = self._waiters
+        while n > 0 and waiters:
+            waiters.popleft().release()
+            n -= 1
+
+    def _sleep(self, deadline, current=None, canceling=None):
+        # require: self._lock must be locked by caller.
+        # return: False if timeout.
+        # current[0] is set to the waiter lock slept on, and Canceled is
+        # raised if canceling is set before sleeping.
+        while not self._list:
+            if canceling is not None and canceling.is_set():
+                raise Canceled()
+            remain_s = deadline.remaining()
+            if remain_s is None:
+                remain_s = -1		# no timeout
+            elif remain_s <= 0:
+                return False
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+            if current is not None:
+                current[0] = waiter
+            self._lock.release()
+            try:
+                woken = waiter.acquire(True, remain_s)
+            finally:
+                self._lock.acquire()
+            if not woken:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass		# released by put just after timeout
+                else:
+                    return bool(self._list)
+        return True
+
+    def _wait(self, tmo_s, cancelable):
+        # require: self._lock must be locked by caller.
+        # return: False if timeout.
+        deadline = Deadline.of(tmo_s)
+        t = threading.current_thread()
+        if not (cancelable and getattr(t, 'cancelable', False)):
+            return self._sleep(deadline)
+        current = [None]
+
+        def waker():
+            # called by Thread.cancel: release own waiter unless already
+            # released by put.
+            with self._lock:
+                waiter = current[0]
+                if waiter is not None and waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter.release()
+
+        with t.cancel_scope(waker):
+            try:
+                return self._sleep(deadline, current, t._canceling)
+            except Canceled:
+                if self._list:
+                    self._wake(1)	# pass on wakeup possibly taken
+                raise
+
+    def put(self, data):
+        with self._lock:
+            if self._stopped:
+                raise self.AlreadyStopped('Queue.stop is already called.')
+            self._list.append(data)
+            self._wake(1)
+            return self
+
+    def put_many(self, datas):
+        with self._lock:
+            if self._stopped:
+                raise self.AlreadyStopped('Queue.stop is already called.')
+            n = len(self._list)
+            self._list.extend(datas)
+            self._wake(len(self._list) - n)
+            return self
+
+    def get(self, tmo_s = None, cancelable=True):
+        # tmo_s: seconds, Deadline or None (no timeout)
+        with self._lock:
+            if not self._list and not self._wait(tmo_s, cancelable):
+                return self._value_in_tmo
+            data = self._list.popleft()
+            if data is self._value_in_stopped:
+                self._list.appendleft(data)
+            if self._list:
+                self._wake(1)		# pass on to next getter if any
+            return data
+
+    def get_many(self, max_n, tmo_s = None, cancelable=True):
+        # return: list of 1..max_n data, or [value_in_tmo] if timeout.
+        #         value_in_stopped is returned alone and left in queue.
+        with self._lock:
+            if not self._list and not self._wait(tmo_s, cancelable):
+                return [self._value_in_tmo]
+            lst = self._list
+            stopped = self._value_in_stopped
+            datas = []
+            while lst and len(datas) < max_n:
+                if lst[0] is stopped:
+                    if not datas:
+                        datas.append(stopped)
+                    break
+                datas.append(lst.popleft())
+            if lst:
+                self._wake(1)
+            return datas
+
+    def stop(self, soon=False):
+        with self._lock:
+            if soon:
+                self._list.clear()
+                self._stopped = False
+            if self._stopped:
+                raise self.AlreadyStopped('Queue.stop is already called.')
+            self._list.append(self._value_in_stopped)
+            self._stopped = True
+            self._wake(len(self._waiters))
+
+    def clear(self):
+        with self._lock:
+            self._list.clear()
+            self._stopped = False
+
+    def __len__(self):
+        return len(self._list)
+
+# priority
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class _PriorityList(object):
+    # deque-like list used as _list of PriorityHandoffQueue. popleft takes
+    # from the highest priority (lowest level) first, but a lower level
+    # skipped 'aging' times while having data is taken once (starvation
+    # protection). Data appended without level (value_in_stopped) comes
+    # after all levels.
+
+    def __init__(self, levels, aging):
+        self._qs = [collections.deque() for _ in range(levels)]
+        self._skips = [0] * levels
+        self._tail = collections.deque()
+        self._aging = aging
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def push(self, data, level):
+        self._qs[level].append(data)
+        self._n += 1
+
+    def append(self, data):
+        self._tail.append(data)
+        self._n += 1
+
+    def appendleft(self, data):
+        # only for value_in_stopped put back by get.
+        self._tail.appendleft(data)
+        self._n += 1
+
+    def extend(self, datas):
+        for data in datas:
+            self.push(data, PRIORITY_NORMAL)
+
+    def _select(self):
+        # return: level to be taken, or -1 for tail.
+        qs = self._qs
+        top = -1
+        for i in range(len(qs)):
+            if qs[i]:
+                if top < 0:
+                    top = i
+                elif self._skips[i] >= self._aging:
+                    return i
+        return top
+
+    def popleft(self):
+        i = self._select()
+        self._n -= 1
+        if i < 0:
+            return self._tail.popleft()
+        qs = self._qs
+        for j in range(i + 1, len(qs)):
+            if qs[j]:
+                self._skips[j] += 1
+        self._skips[i] = 0
+        return qs[i].popleft()
+
+    def __getitem__(self, idx):
+        # only [0] (next data of popleft) is supported.
+        if idx != 0:
+            raise IndexError(idx)
+        i = self._select()
+        return self._tail[0] if i < 0 else self._qs[i][0]
+
+    def clear(self):
+        for q in self._qs:
+            q.clear()
+        self._tail.clear()
+        self._skips = [0] * len(self._qs)
+        self._n = 0
+
+class PriorityHandoffQueue(HandoffQueue):
+    # HandoffQueue with priority levels (PRIORITY_HIGH/NORMAL/LOW).
+    # Each waiting lower level is taken at least once per 'aging' data
+    # taken from higher levels.
+
+    def __new__(cls, value_in_tmo = None, value_in_stopped = False,
+                levels = 3, aging = 8):
+        self = super().__new__(cls, value_in_tmo, value_in_stopped)
+        self._list = _PriorityList(levels, aging)
+        return self
+
+    def put(self, data, priority = PRIORITY_NORMAL):
+        with self._lock:
+            if self._stopped:
+                raise self.AlreadyStopped('Queue.stop is already called.')
+            self._list.push(data, priority)
+            self._wake(1)
+            return self
+
+    def put_many(self, datas, priority = PRIORITY_NORMAL):
+        with self._lock:
+            if self._stopped:
+                raise self.AlreadyStopped('Queue.stop is already called.')
+            n = 0
+            for data in datas:
+                self._list.push(data, priority)
+                n += 1
+            self._wake(n)
+            return self
+
 #-----------------------------------------------------------------------------
 #                                Thread pool
 #-----------------------------------------------------------------------------
 
-class ThreadPool(object):
+# futures (concurrent.futures compatible)
+
+def _run_future(future, action, args, kwargs):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = action(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+class _FutureSupport(object):
+    # submit/map of concurrent.futures.Executor on top of queue.
+
+    def submit(self, action, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.queue(_run_future, future, action, args, kwargs)
+        return future
+
+    def map(self, action, *iterables, timeout=None):
+        lim_s = None if timeout is None else time.monotonic() + timeout
+        fs = [self.submit(action, *args) for args in zip(*iterables)]
+        def _results():
+            try:
+                fs.reverse()
+                while fs:
+                    if lim_s is None:
+                        yield fs.pop().result()
+                    else:
+                        yield fs.pop().result(lim_s - time.monotonic())
+            finally:
+                for f in fs:
+                    f.cancel()
+        return _results()
+
+def as_completed(fs, timeout=None):
+    return concurrent.futures.as_completed(fs, timeout)
+
+
+# metrics
+
+class Histogram(object):
+    # Histogram of durations with power-of-2 microsecond buckets:
+    # bucket i counts durations in [2**(i-1), 2**i) us (bucket 0: < 1us).
+    NBUCKET = 40
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.buckets = [0] * self.NBUCKET
+
+    def add(self, dt_s):
+        # require: caller serializes calls.
+        self.count += 1
+        self.total_s += dt_s
+        if dt_s > self.max_s:
+            self.max_s = dt_s
+        i = min(int(dt_s * 1e6).bit_length(), self.NBUCKET - 1)
+        self.buckets[i] += 1
+
+    def percentile(self, p):
+        # return: upper bound (seconds) of bucket including p-th percentile.
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        n = 0
+        for i in range(self.NBUCKET):	# (enumerate is threading's here)
+            n += self.buckets[i]
+            if n >= rank:
+                return min((1 << i) / 1e6, self.max_s)
+        return self.max_s
+
+    def summary(self):
+        return tb.nameddict(count=self.count,
+                            mean_s=self.total_s / self.count if self.count else 0.0,
+                            p50_s=self.percentile(50),
+                            p90_s=self.percentile(90),
+                            p99_s=self.percentile(99),
+                            max_s=self.max_s,
+                            buckets=list(self.buckets))
+
+class PoolMetrics(object):
+    # Counters of ThreadPool updated only while enabled by
+    # ThreadPool.enable_metrics.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.wait = Histogram()	# queued -> started
+            self.run = Histogram()	# started -> finished
+            self.rejected = 0		# queued after end()
+            self.expired = 0		# not run because of deadline
+            self.peak_queued = 0
+            self.peak_active = 0
+            self.peak_threads = 0
+            self.since = time.monotonic()
+
+    def _queued(self, c_que, c_cur):
+        with self._lock:
+            if c_que > self.peak_queued:
+                self.peak_queued = c_que
+            if c_cur > self.peak_threads:
+                self.peak_threads = c_cur
+
+    def _started(self, wait_s, c_act):
+        with self._lock:
+            self.wait.add(wait_s)
+            if c_act > self.peak_active:
+                self.peak_active = c_act
+
+    def _finished(self, run_s):
+        with self._lock:
+            self.run.add(run_s)
+
+    def _expired(self):
+        with self._lock:
+            self.expired += 1
+
+    def _rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            return tb.nameddict(period_s=time.monotonic() - self.since,
+                                wait=self.wait.summary(),
+                                run=self.run.summary(),
+                                rejected=self.rejected,
+                                expired=self.expired,
+                                peak_queued=self.peak_queued,
+                                peak_active=self.peak_active,
+                                peak_threads=self.peak_threads)
+
+# sizing policies (all methods are called with pool._lock locked)
+
+def _idle_tmo(*tmos):
+    # return: shortest of idle timeouts where 0/None means no timeout,
+    #         or None if none of them times out.
+    tmos = [t for t in tmos if t]
+    return min(tmos) if tmos else None
+
+class SizingPolicy(object):
+    # Default policy of ThreadPool: thread is added while queued and
+    # active tasks are not less than threads (up to thread_max), and idle
+    # thread exits after thread_tmo while idle threads exceed thread_lwm.
+
+    def attach(self, pool):
+        pass
+
+    def want_thread(self, pool):
+        # called by queue: True to add a thread.
+        return (pool._c_cur < pool._c_max and
+                pool._c_cur <= pool._c_que + pool._c_act)
+
+    def completed(self, pool):
+        # called after each task.
+        # return: <0 to let the worker exit, >0 to add a thread.
+        return 0
+
+    def idle_tmo_s(self, pool):
+        # return: seconds, or None for no idle timeout (thread_tmo 0/None).
+        return _idle_tmo(pool._c_tmo)
+
+    def idle_exit(self, pool):
+        # called when a worker is idle for idle_tmo_s: True to exit.
+        return pool._c_cur - pool._c_act > pool._c_lwm
+
+class HillClimbingPolicy(SizingPolicy):
+    # Adaptive policy like .NET thread pool. Every interval_s, throughput
+    # (completed tasks/s) is compared with the previous interval, and the
+    # concurrency limit keeps moving in same direction while throughput
+    # improves by min_gain or more, and reverses if it drops. If flat, it
+    # goes up while mean queue wait of the interval exceeds wait_target_s
+    # (tasks are delayed, e.g. by blocking ones), and down otherwise (same
+    # throughput with fewer threads). Queue wait is taken from metrics of
+    # pool, which attach enables. Limit is kept within
+    # [max(thread_lwm, 1), thread_max], grows only while tasks are queued,
+    # and follows demand down when queue is empty. Threads above limit
+    # exit after their task, and idle ones after idle_tmo_s.
+    #
+    # Starvation guard: one shared daemon thread checks pools of all
+    # instances every interval_s, and adds a thread (raising limit) if
+    # tasks are queued, all threads are busy and no task completed in the
+    # interval, e.g. when running tasks wait for queued ones. Nothing else
+    # would add a thread in that state.
+    #
+    # It has state of a pool, so don't share an instance among pools.
+
+    _g_lock = threading.Lock()
+    _g_pools = weakref.WeakSet()	# pools checked by guard thread
+    _g_guard = None
+
+    def __init__(self, interval_s=0.1, step=1, min_gain=0.05, idle_tmo_s=5.0,
+                 wait_target_s=0.01):
+        self.interval_s = interval_s
+        self.step = step
+        self.min_gain = min_gain
+        self.wait_target_s = wait_target_s
+        self._idle_tmo_s = idle_tmo_s
+        self.limit = 1
+
+    def attach(self, pool):
+        self.limit = max(pool._c_lwm, 1)
+        self._dir = 1
+        self._mult = 1
+        self._done = 0
+        self._done_all = 0
+        self._tput = None
+        self._wait = (None, 0, 0.0)	# (histogram, count, total_s) at last tick
+        self._last = time.monotonic()
+        self._next = self._last + self.interval_s
+        self._g_next = self._next
+        self._g_done = -1
+        pool.enable_metrics()
+        cls = HillClimbingPolicy
+        with cls._g_lock:
+            cls._g_pools.add(pool)
+            if cls._g_guard is None or not cls._g_guard.is_alive():
+                t = cls._g_guard = Thread(target=cls._guard_thread)
+                t.name = 'HillClimbingPolicy(guard)'
+                t.daemon = True
+                t.start()
+
+    @classmethod
+    def _guard_thread(cls):
+        while True:
+            with cls._g_lock:
+                pools = [p for p in cls._g_pools
+                         if isinstance(p._sizing, HillClimbingPolicy)]
+                if not pools:
+                    cls._g_guard = None	# pools are freed or policy replaced
+                    return
+            itv_s = min(p._sizing.interval_s for p in pools)
+            now = time.monotonic()
+            for pool in pools:
+                with pool._lock:
+                    policy = pool._sizing
+                    if isinstance(policy, HillClimbingPolicy):
+                        policy._guard(pool, now)
+            pool = policy = pools = None
+            time.sleep(itv_s)
+
+    def _guard(self, pool, now):
+        if now < self._g_next:
+            return
+        self._g_next = now + self.interval_s
+        if (pool._available and pool._c_que > 0 and
+            pool._c_act >= pool._c_cur and pool._c_cur < pool._c_max and
+            self._g_done == self._done_all):
+            self.limit = max(self.limit, pool._c_cur + 1)
+            pool._add_thread()
+            pool._c_cur += 1
+        self._g_done = self._done_all
+
+    def _wait_s(self, pool):
+        # return: mean queue wait since last tick, or None if unknown.
+        metrics = pool._metrics
+        if metrics is None:			# disabled by user
+            return None
+        hist = metrics.wait
+        last, count, total_s = self._wait
+        self._wait = (hist, hist.count, hist.total_s)
+        if hist is not last or hist.count <= count:	# reset, or no sample
+            return None
+        return (hist.total_s - total_s) / (hist.count - count)
+
+    def _tick(self, pool):
+        now = time.monotonic()
+        if now < self._next:
+            return
+        tput = self._done / (now - self._last)
+        self._done = 0
+        self._last = now
+        self._next = now + self.interval_s
+        wait_s = self._wait_s(pool)
+        lo = max(pool._c_lwm, 1)
+        hi = max(pool._c_max, lo)
+        prev, self._tput = self._tput, tput
+        if pool._c_que == 0:
+            # no backlog: follow demand down.
+            self.limit = min(max(pool._c_act, lo), self.limit)
+            self._dir, self._mult = 1, 1
+            return
+        if prev is None or tput >= prev * (1 + self.min_gain):
+            self._mult = min(self._mult * 2, 16) if prev is not None else 1
+        elif tput <= prev * (1 - self.min_gain):
+            self._dir, self._mult = -self._dir, 1
+        elif wait_s is not None and wait_s > self.wait_target_s:
+            self._dir, self._mult = 1, 1
+        else:
+            self._dir, self._mult = -1, 1
+        self.limit = min(max(self.limit + self._dir * self.step * self._mult, lo), hi)
+
+    def want_thread(self, pool):
+        self._tick(pool)
+        return (pool._c_cur < min(self.limit, pool._c_max) and
+                pool._c_cur <= pool._c_que + pool._c_act)
+
+    def completed(self, pool):
+        self._done += 1
+        self._done_all += 1
+        self._tick(pool)
+        if pool._c_cur > max(self.limit, pool._c_lwm, 1):
+            return -1
+        if pool._c_que > 0 and pool._c_cur < min(self.limit, pool._c_max):
+            return 1			# limit is raised while backlogged
+        return 0
+
+    def idle_tmo_s(self, pool):
+        return _idle_tmo(pool._c_tmo, self._idle_tmo_s)
+
+class ThreadPool(_FutureSupport):
     _g_lock = threading.Lock()
     _g_count = 0
 
@@ -174,13 +897,13 @@ class ThreadPool(object):
     thread_lwm = tb.SimpleProperty('_c_lwm')
     thread_tmo = tb.SimpleProperty('_c_tmo')
 
-    def __new__(cls, thread_max=8, thread_lwm=1, thread_tmo=120):
+    def __new__(cls, thread_max=8, thread_lwm=1, thread_tmo=120, sizing=None):
         self = super().__new__(cls)
         with cls._g_lock:
             self._name = 'POOL#%d' % cls._g_count
             cls._g_count += 1
-        self._que = Queue(value_in_tmo = (False, None, None),
-                          value_in_stopped = (None, None, None))
+        self._que = PriorityHandoffQueue(value_in_tmo = (False, None, None),
+                                         value_in_stopped = (None, None, None))
         self._lock = threading.Lock()
         self._no_worker = Event()
         self._available = False
@@ -191,15 +914,97 @@ class ThreadPool(object):
         self._c_max = thread_max		# must be parameter
         self._c_lwm = thread_lwm
         self._c_tmo = thread_tmo
+        self._metrics = None
+        self._reporter = None
+        self.sizing = sizing
         return self
-    
+
+    @property
+    def sizing(self):
+        return self._sizing
+
+    @sizing.setter
+    def sizing(self, policy):
+        # policy: SizingPolicy (default) or HillClimbingPolicy instance.
+        with self._lock:
+            policy = policy or SizingPolicy()
+            policy.attach(self)
+            self._sizing = policy
+
+    # metrics
+
+    def enable_metrics(self, enable=True):
+        # While disabled, queue/worker only test that _metrics is None.
+        if enable:
+            if self._metrics is None:
+                self._metrics = PoolMetrics()
+        else:
+            self._metrics = None
+        return self
+
+    def snapshot(self):
+        # return: current thread counts, and metrics if enabled.
+        with self._lock:
+            snap = tb.nameddict(threads=self._c_cur,
+                                active=self._c_act,
+                                idle=self._c_cur - self._c_act,
+                                queued=self._c_que,
+                                thread_max=self._c_max,
+                                thread_lwm=self._c_lwm)
+        metrics = self._metrics
+        if metrics is not None:
+            snap.update(metrics.snapshot())
+        return snap
+
+    def report_every(self, interval_s, output=None, reset=False):
+        # Call output(snapshot) every interval_s seconds in a daemon thread,
+        # where snapshot is tb.nameddict returned by snapshot(). Default
+        # output prints it by pr. interval_s=None stops reporting.
+        # reset: metrics are reset after each report (per interval).
+        if self._reporter:
+            self._reporter.set()
+            self._reporter = None
+        if interval_s is None:
+            return self
+        self.enable_metrics()
+        stop = self._reporter = Event()
+        output = output or (lambda snap: pr('%s', snap))
+        def _report():
+            while not stop.wait(interval_s):
+                try:
+                    output(self.snapshot())
+                    metrics = self._metrics
+                    if reset and metrics is not None:
+                        metrics.reset()
+                except:
+                    traceback.print_exc()
+        t = Thread(target=_report)
+        t.name = self._name + '(report)'
+        t.daemon = True
+        t.start()
+        return self
+
+    def _measured(self, metrics, t_queued, action, args, kwargs):
+        if action == self._deadlined:
+            if self._expire_if_late(*args):
+                return		# expired task is not recorded in wait/run
+            _, _, action, args, kwargs = args
+        t_start = time.perf_counter()
+        metrics._started(t_start - t_queued, self._c_act)
+        try:
+            action(*args, **kwargs)
+        finally:
+            metrics._finished(time.perf_counter() - t_start)
+
     def _worker_thread(self):
         self._no_worker.clear()
         while True:
-            action, args, kwargs = self._que.get(self._c_tmo)
+            # 0 from policy also means no idle timeout (not polling).
+            action, args, kwargs = self._que.get(self._sizing.idle_tmo_s(self) or None,
+                                                 cancelable=False)
             if action is False:			# timeout
                 with self._lock:
-                    if self._c_cur - self._c_act > self._c_lwm:
+                    if self._sizing.idle_exit(self):
                         self._c_cur -= 1
                         return
                 continue
@@ -221,6 +1026,13 @@ class ThreadPool(object):
             action = args = kwargs = None
             with self._lock:
                 self._c_act -= 1
+                delta = self._sizing.completed(self)
+                if delta < 0:
+                    self._c_cur -= 1
+                    return
+                if delta > 0:
+                    self._add_thread()
+                    self._c_cur += 1
 
     def _add_thread(self):
         # require: self._lock must be locked by self.
@@ -238,17 +1050,70 @@ class ThreadPool(object):
         return self
 
     def queue(self, action, *args, **kwargs):
+        return self._queue(action, args, kwargs, PRIORITY_NORMAL)
+
+    def queue_task(self, action, args=(), kwargs=None,
+                   priority=PRIORITY_NORMAL, deadline_s=None, on_expired=None):
+        # priority:   PRIORITY_HIGH/NORMAL/LOW (see PriorityHandoffQueue).
+        # deadline_s: task not started within deadline_s seconds is not
+        #             run, and on_expired(action, args, kwargs) is called
+        #             instead if given.
+        if priority not in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            raise ValueError('Invalid priority: %s' % priority)
+        kwargs = kwargs if kwargs else {}
+        if deadline_s is not None:
+            if not callable(action):
+                raise RuntimeError('1st argument must be callable.')
+            args = (time.monotonic() + deadline_s, on_expired, action, args, kwargs)
+            action, kwargs = self._deadlined, {}
+        return self._queue(action, args, kwargs, priority)
+
+    def submit_task(self, action, args=(), kwargs=None,
+                    priority=PRIORITY_NORMAL, deadline_s=None):
+        # Future of task expired by deadline fails with DeadlineExceeded.
+        future = concurrent.futures.Future()
+        def on_expired(*_):
+            if future.set_running_or_notify_cancel():
+                future.set_exception(DeadlineExceeded('Deadline passed before start.'))
+        self.queue_task(_run_future, (future, action, args, kwargs or {}),
+                        priority=priority, deadline_s=deadline_s,
+                        on_expired=on_expired)
+        return future
+
+    def _deadlined(self, deadline, on_expired, action, args, kwargs):
+        if not self._expire_if_late(deadline, on_expired, action, args, kwargs):
+            action(*args, **kwargs)
+
+    def _expire_if_late(self, deadline, on_expired, action, args, kwargs):
+        # return: True if deadline has passed (counted as expired).
+        if time.monotonic() <= deadline:
+            return False
+        metrics = self._metrics
+        if metrics is not None:
+            metrics._expired()
+        if on_expired:
+            on_expired(action, args, kwargs)
+        return True
+
+    def _queue(self, action, args, kwargs, priority):
         if not callable(action):
             raise RuntimeError('1st argument must be callable.')
+        metrics = self._metrics
         with self._lock:
             if not self._available:
+                if metrics is not None:
+                    metrics._rejected()
                 raise RuntimeError('ThreadPool is now inactive.')
-            if (self._c_cur < self._c_max and
-                self._c_cur <= self._c_que + self._c_act):
+            if self._sizing.want_thread(self):
                 self._add_thread()
                 self._c_cur += 1
             self._c_que += 1
-        self._que.put((action, args, kwargs))
+            if metrics is not None:
+                metrics._queued(self._c_que, self._c_cur)
+        if metrics is not None:
+            args = (metrics, time.perf_counter(), action, args, kwargs)
+            action, kwargs = self._measured, {}
+        self._que.put((action, args, kwargs), priority)
         return self
 
     def end(self, soon = False):
@@ -260,8 +1125,439 @@ class ThreadPool(object):
     def wait(self):
         self._no_worker.wait()
 
+    def _after_fork(self):
+        # Forked child has none of the worker threads, and locks may be
+        # held by them, so counters and queue are reset. Tasks queued in
+        # parent are not run in child.
+        self._que = PriorityHandoffQueue(value_in_tmo = (False, None, None),
+                                         value_in_stopped = (None, None, None))
+        self._lock = threading.Lock()
+        self._no_worker = Event()
+        self._no_worker.set()
+        self._c_que = 0
+        self._c_cur = 0
+        self._c_act = 0
+        if self._metrics is not None:
+            self._metrics = PoolMetrics()
+        self._reporter = None
+        self._sizing.attach(self)
+
 threadpool = ThreadPool(thread_max=128, thread_lwm=8)
 threadpool.start()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: threadpool._after_fork())
+
+#-----------------------------------------------------------------------------
+#                         Work-stealing thread pool
+#-----------------------------------------------------------------------------
+
+class WorkStealingPool(_FutureSupport):
+    # Same API as ThreadPool. Each worker has own deque: task queued by a
+    # worker is pushed to its deque and popped by itself (LIFO), and idle
+    # worker steals the oldest task from others (FIFO). Task queued by
+    # other threads goes to shared injection deque. No lock is taken to
+    # queue/take a task unless some worker is sleeping.
+    _g_lock = threading.Lock()
+    _g_count = 0
+
+    thread_max = tb.SimpleProperty('_c_max')
+    thread_lwm = tb.SimpleProperty('_c_lwm')
+    thread_tmo = tb.SimpleProperty('_c_tmo')
+
+    class _Worker(object):
+        __slots__ = ('local',)
+
+        def __init__(self):
+            self.local = collections.deque()
+
+    def __new__(cls, thread_max=8, thread_lwm=1, thread_tmo=120):
+        self = super().__new__(cls)
+        with cls._g_lock:
+            self._name = 'WSPOOL#%d' % cls._g_count
+            cls._g_count += 1
+        self._inject = collections.deque()
+        self._workers = ()		# replaced (not modified) under _lock
+        self._tls = threading.local()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._no_worker = Event()
+        self._available = False
+        self._stopping = False
+        self._tid = 0
+        self._c_cur = 0
+        self._c_idle = 0
+        self._c_max = thread_max
+        self._c_lwm = thread_lwm
+        self._c_tmo = thread_tmo
+        return self
+
+    def _find_task(self, me):
+        try:
+            return me.local.pop()
+        except IndexError:
+            pass
+        try:
+            return self._inject.popleft()
+        except IndexError:
+            pass
+        for w in self._workers:
+            if w is not me:
+                try:
+                    return w.local.popleft()
+                except IndexError:
+                    pass
+        return None
+
+    def _sleep(self, me):
+        # return: task, or None if worker has exited.
+        # Task is rechecked after timeout too, since notify by queue may
+        # miss a waiter timing out, and worker is removed in same lock so
+        # that queue sees either idle worker or room for a new thread.
+        with self._cond:
+            self._c_idle += 1
+            try:
+                timed_out = False
+                while True:
+                    task = self._find_task(me)	# recheck with idle counted
+                    if task is not None:
+                        return task
+                    if self._stopping or (timed_out and
+                                          self._c_idle > self._c_lwm):
+                        break
+                    timed_out = not self._cond.wait(self._c_tmo or None)
+            finally:
+                self._c_idle -= 1
+            self._exit(me)
+            return None
+
+    def _exit(self, me):
+        # require: self._lock must be locked by self.
+        self._workers = tuple(w for w in self._workers if w is not me)
+        self._c_cur -= 1
+        if self._c_cur == 0:
+            self._no_worker.set()
+
+    def _worker_thread(self):
+        me = self._tls.worker = self._Worker()
+        with self._lock:
+            self._workers += (me,)
+        clear_cancel = threading.current_thread().clear_cancel
+        while True:
+            task = self._find_task(me) or self._sleep(me)
+            if task is None:
+                return
+            action, args, kwargs = task
+            try:
+                clear_cancel()
+                action(*args, **kwargs)
+            except:
+                traceback.print_exc()
+            task = action = args = kwargs = None
+
+    def _add_thread(self):
+        # require: self._lock must be locked by self.
+        self._tid += 1
+        self._c_cur += 1
+        self._no_worker.clear()
+        t = Thread(target=self._worker_thread)
+        t.name = '%s<%d>' % (self._name, self._tid)
+        t.daemon = True
+        t.start()
+
+    def start(self):
+        with self._lock:
+            if not self._available:
+                self._inject.clear()
+                self._stopping = False
+                self._available = True
+        return self
+
+    def queue(self, action, *args, **kwargs):
+        if not callable(action):
+            raise RuntimeError('1st argument must be callable.')
+        if not self._available:
+            raise RuntimeError('WorkStealingPool is now inactive.')
+        me = getattr(self._tls, 'worker', None)
+        (me.local if me else self._inject).append((action, args, kwargs))
+        if self._c_idle:
+            with self._cond:
+                if self._c_idle:
+                    self._cond.notify()
+                elif self._c_cur < self._c_max:	# idle one has exited
+                    self._add_thread()
+        elif self._c_cur < self._c_max:
+            with self._lock:
+                if not self._c_idle and self._c_cur < self._c_max:
+                    self._add_thread()
+        return self
+
+    def end(self, soon = False):
+        with self._cond:
+            self._available = False
+            self._stopping = True
+            if soon:
+                self._inject.clear()
+                for w in self._workers:
+                    w.local.clear()
+            self._cond.notify_all()
+            if self._c_cur == 0:
+                self._no_worker.set()
+        return self
+
+    def wait(self):
+        self._no_worker.wait()
+
+#-----------------------------------------------------------------------------
+#                     Process pool (for CPU bound actions)
+#-----------------------------------------------------------------------------
+
+class _SharedBytes(object):
+    # Placeholder of large bytes-like argument. Data is copied into shared
+    # memory by parent, and unpickled as bytes (or bytearray) in worker.
+
+    def __init__(self, shm, n, kind):
+        self._shm = shm
+        self._n = n
+        self._kind = kind
+
+    def __reduce__(self):
+        return (_attach_shared, (self._shm.name, self._n, self._kind))
+
+def _attach_shared(name, n, kind):
+    from multiprocessing import shared_memory, resource_tracker
+    shm = shared_memory.SharedMemory(name)
+    try:
+        # parent owns the segment: don't let tracker of worker unlink it.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    try:
+        return kind(shm.buf[:n])
+    finally:
+        shm.close()
+
+def _process_run(data):
+    import _pickle
+    action, args, kwargs = _pickle.loads(data)
+    return action(*args, **kwargs)
+
+def _process_warm():
+    return None
+
+class ProcessPool(_FutureSupport):
+    # ThreadPool API backed by worker processes, for CPU bound actions
+    # which are serialized by GIL on ThreadPool.
+    #
+    # action, args and kwargs are pickled by queue (so action must be a
+    # module level function or a bound method of picklable object), and
+    # bytes-like argument of SHM_THRESHOLD bytes or more is passed through
+    # shared memory. Workers are started by start and kept until end.
+    #
+    # queue discards result and prints exception (with remote traceback)
+    # as ThreadPool does. queue_with_result calls on_done(success, value)
+    # in a thread of this process, where value is result or exception.
+    SHM_THRESHOLD = (1024*1024)
+
+    process_max = tb.SimpleProperty('_c_max')	# effective by next start
+
+    def __new__(cls, process_max=None, warm=True):
+        self = super().__new__(cls)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._no_task = Event()
+        self._available = False
+        self._warm = warm
+        self._c_out = 0			# outstanding actions
+        self._c_max = process_max or os.cpu_count() or 1
+        return self
+
+    def start(self):
+        from concurrent.futures import ProcessPoolExecutor
+        with self._lock:
+            if not self._available:
+                self._executor = ProcessPoolExecutor(max_workers=self._c_max)
+                self._no_task.clear()
+                self._available = True
+                if self._warm:
+                    for _ in range(self._c_max):
+                        self._executor.submit(_process_warm)
+        return self
+
+    def _share(self, v, shms):
+        if not (isinstance(v, (bytes, bytearray, memoryview)) and
+                len(v) >= self.SHM_THRESHOLD):
+            return v
+        from multiprocessing import shared_memory
+        n = memoryview(v).nbytes
+        shm = shared_memory.SharedMemory(create=True, size=n)
+        shms.append(shm)
+        shm.buf[:n] = memoryview(v).cast('B')
+        return _SharedBytes(shm, n, bytearray if isinstance(v, bytearray) else bytes)
+
+    def queue(self, action, *args, **kwargs):
+        return self.queue_with_result(None, action, *args, **kwargs)
+
+    def queue_with_result(self, on_done, action, *args, **kwargs):
+        import _pickle
+        if not callable(action):
+            raise RuntimeError('1st argument must be callable.')
+        shms = []
+        try:
+            args = tuple(self._share(v, shms) for v in args)
+            kwargs = dict((k, self._share(v, shms)) for k, v in kwargs.items())
+            data = _pickle.dumps((action, args, kwargs), -1)
+            with self._lock:
+                if not self._available:
+                    raise RuntimeError('ProcessPool is now inactive.')
+                future = self._executor.submit(_process_run, data)
+                self._c_out += 1
+        except:
+            self._release(shms)
+            raise
+        future.add_done_callback(functools.partial(self._done, on_done, shms))
+        return self
+
+    def submit(self, action, *args, **kwargs):
+        # returned future is already running (can't be canceled).
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        def on_done(success, value):
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        self.queue_with_result(on_done, action, *args, **kwargs)
+        return future
+
+    @staticmethod
+    def _release(shms):
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    def _done(self, on_done, shms, future):
+        self._release(shms)
+        if future.cancelled():
+            success, value = False, Canceled()
+        elif future.exception() is not None:
+            success, value = False, future.exception()
+        else:
+            success, value = True, future.result()
+        try:
+            if on_done:
+                on_done(success, value)
+            elif not success and not isinstance(value, Canceled):
+                traceback.print_exception(type(value), value, value.__traceback__)
+        except:
+            traceback.print_exc()
+        with self._lock:
+            self._c_out -= 1
+            if self._c_out == 0 and not self._available:
+                self._no_task.set()
+
+    def end(self, soon = False):
+        with self._lock:
+            if not self._available:
+                return self
+            self._available = False
+            executor, self._executor = self._executor, None
+            if self._c_out == 0:
+                self._no_task.set()
+        executor.shutdown(wait=False, cancel_futures=soon)
+        return self
+
+    def wait(self):
+        self._no_task.wait()
+
+#-----------------------------------------------------------------------------
+#                     concurrent.futures.Executor adapter
+#-----------------------------------------------------------------------------
+
+class PoolExecutor(concurrent.futures.Executor):
+    # Executor using pool (ThreadPool, WorkStealingPool or ProcessPool),
+    # which is also accepted by asyncio's loop.run_in_executor. shutdown
+    # only stops this executor: pool is not ended because it may be
+    # shared (threadpool by default).
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._shutdown = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            future = (self._pool or threadpool).submit(fn, *args, **kwargs)
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            fs = list(self._futures)
+        if cancel_futures:
+            for f in fs:
+                f.cancel()
+        if wait:
+            concurrent.futures.wait(fs)
+
+#-----------------------------------------------------------------------------
+#                  Serialized execution on top of thread pool
+#-----------------------------------------------------------------------------
+
+class SerialQueue(object):
+    # Actions queued to same SerialQueue run one by one in queued order,
+    # but no thread is dedicated to it. Only while some actions are
+    # pending, one thread of the pool is borrowed to drain them.
+
+    def __new__(cls, threadpool=None):
+        self = super().__new__(cls)
+        self._threadpool = threadpool
+        self._list = collections.deque()
+        self._lock = threading.Lock()
+        self._running = False
+        return self
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._list:
+                    self._running = False
+                    return
+                action, args, kwargs = self._list.popleft()
+            try:
+                threading.current_thread().clear_cancel()
+                action(*args, **kwargs)
+            except:
+                traceback.print_exc()
+            action = args = kwargs = None
+
+    def queue(self, action, *args, **kwargs):
+        if not callable(action):
+            raise RuntimeError('1st argument must be callable.')
+        with self._lock:
+            self._list.append((action, args, kwargs))
+            if self._running:
+                return self
+            self._running = True
+        try:
+            (self._threadpool or threadpool).queue(self._drain)
+        except:
+            with self._lock:
+                self._list.clear()
+                self._running = False
+            raise
+        return self
+
+    def __len__(self):
+        return len(self._list)
 
 #-----------------------------------------------------------------------------
 #
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import atexit
+import heapq
 import io
+import itertools
 import os
 import os.path
+import sys
 import threading
 import traceback
 import time
@@ -13,6 +17,7 @@ with _opt as _def:
     _def('TPP_PR_NAME', 'i', '[tpp.toolbox] toolbox.pr add self thread name', 1)
     _def('TPP_EXC_DEBUG', 'i', '[tpp.toolbox] no_except print traceback', 0)
     _def('TPP_BPR_NOLIMIT', 'i', "[tpp.toolbox] BufferedPrint do't omit string", 0)
+    _def('TPP_PR_ASYNC', 'i', '[tpp.toolbox] toolbox.pr write by background thread', 0)
 
 #----------------------------------------------------------------------------
 #                              Small utilities
@@ -22,17 +27,56 @@ def alignP2(_z, p2):
     return ((_z | (p2-1)) + 1)
 
 class _Printer(object):
+    # pr writes synchronously under global lock, or by AsyncWriter after
+    # start_async (or if TPP_PR_ASYNC is set). After stop_async, pr is
+    # synchronous even if TPP_PR_ASYNC is set, until start_async.
     __slots__ = ()
     _lock = threading.Lock()
+    _writer = None
+    _stopped = False
 
     def __call__(self, fmt, *args):
         if _opt.TPP_PR_NAME:
             fmt = threading.current_thread().name + ': ' +fmt
         s = fmt % args
+        writer = _Printer._writer
+        if writer is None and _opt.TPP_PR_ASYNC and not _Printer._stopped:
+            writer = self._start(True, {})
+        if writer is not None:
+            writer.write(s)
+            return
         with self._lock:
             print(s)
 
+    def start_async(self, **kwargs):
+        # kwargs: passed to AsyncWriter if not started yet.
+        return self._start(False, kwargs)
+
+    def _start(self, auto, kwargs):
+        # return: writer, or None if auto start is after stop_async.
+        with self._lock:
+            if auto and _Printer._stopped:
+                return None
+            _Printer._stopped = False
+            if _Printer._writer is None:
+                _Printer._writer = AsyncWriter(**kwargs)
+            return _Printer._writer
+
+    def stop_async(self):
+        # write out all buffered and go back to synchronous print.
+        with self._lock:
+            writer, _Printer._writer = _Printer._writer, None
+            _Printer._stopped = True
+        if writer is not None:
+            writer.close()
+
+    def flush(self):
+        writer = _Printer._writer
+        if writer is not None:
+            writer.flush()
+
 pr = _Printer()
+atexit.register(pr.stop_async)
 
 class no_abort(object):
     def __init__(self):
@@ -144,6 +188,10 @@ class Null(object):
         return False
     def __iter__(self):
         return iter([])
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        pass
 
 Null = Null()
 
@@ -216,6 +264,42 @@ class fn(object):
                 path = _find(name, alt_list.split(':'))
         return path
 
+#----------------------------------------------------------------------------
+#                        Deadline on monotonic clock
+#----------------------------------------------------------------------------
+
+class Deadline(object):
+    # Absolute point on time.monotonic, so that one deadline can be passed
+    # through a chain of waits (queue, mailbox, socket...) and each wait
+    # takes only what remains. tmo_s None means no deadline.
+    __slots__ = ('limit',)
+
+    def __new__(cls, tmo_s=None):
+        self = super().__new__(cls)
+        self.limit = None if tmo_s is None else time.monotonic() + tmo_s
+        return self
+
+    @classmethod
+    def of(cls, tmo):
+        # tmo: Deadline, seconds or None.
+        return tmo if isinstance(tmo, Deadline) else cls(tmo)
+
+    def remaining(self):
+        # return: seconds to wait (0 if expired, capped by TIMEOUT_MAX),
+        #         or None if no deadline.
+        if self.limit is None:
+            return None
+        return min(max(self.limit - time.monotonic(), 0.0), threading.TIMEOUT_MAX)
+
+    @property
+    def expired(self):
+        return self.limit is not None and self.limit <= time.monotonic()
+
+    def __repr__(self):
+        if self.limit is None:
+            return '<Deadline: never>'
+        return '<Deadline: %.3fs left>' % (self.limit - time.monotonic())
+
 #----------------------------------------------------------------------------
 #                     Message exchanger by onetime key
 #----------------------------------------------------------------------------
@@ -258,20 +342,139 @@ class OnetimeMsgBox(object):
             elif strict:
                 raise KeyError("Specified key '%s' is not reserved." % key)
 
-    def wait(self, key, tmo_s = None):
-        if tmo_s is None:
-            tmo_s = (3600*24*365*10)
-        lim_tv = time.time() + tmo_s
+    def _cancel_waker(self):
         with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, key, tmo_s = None):
+        # tmo_s: seconds, Deadline or None (no timeout)
+        # Canceled of threadutil is raised if waiting threadutil.Thread is
+        # canceled (key is left reserved, so call cancel(key) to drop it).
+        deadline = Deadline.of(tmo_s)
+        t = threading.current_thread()
+        if getattr(t, 'cancelable', False):
+            scope = t.cancel_scope(self._cancel_waker)
+        else:
+            scope = Null
+        with self._cond, scope:
             # self._mbox[key] is not None if post is called.
             while self._mbox[key] is None:
-                self._cond.wait(tmo_s)
-                now_tv = time.time()
-                if now_tv >= lim_tv:
+                if deadline.expired:
                     return None		# timeout
-                tmo_s = lim_tv - now_tv
+                self._cond.wait(deadline.remaining())
+                scope.check()
             return self._mbox.pop(key)[0]
 
+#----------------------------------------------------------------------------
+#                    Asynchronous line writer (pr backend)
+#----------------------------------------------------------------------------
+
+class _LineBuffer(object):
+    __slots__ = ('thread', 'lock', 'lines', 'size', 'dropped')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.lock = threading.Lock()	# contended only by writer thread
+        self.lines = []			# (seq, line)
+        self.size = 0
+        self.dropped = 0
+
+class AsyncWriter(object):
+    # Callers append lines to buffer of their own thread only, and one
+    # daemon thread writes them out every interval_s (or sooner when some
+    # buffer is half full) by one write in call order. Each thread keeps
+    # at most buf_b bytes; lines beyond it are dropped and counted in
+    # 'dropped', which is also reported in the output.
+
+    def __new__(cls, stream=None, buf_b=65536, interval_s=0.05):
+        # stream: None means sys.stdout at each write.
+        self = super().__new__(cls)
+        self._stream = stream
+        self._buf_b = buf_b
+        self._interval_s = interval_s
+        self._seq = itertools.count()
+        self._tls = threading.local()
+        self._bufs = []
+        self._b_lock = threading.Lock()		# for self._bufs
+        self._w_lock = threading.Lock()		# for writing out
+        self._wake = threading.Event()
+        self._closed = False
+        self.dropped = 0
+        t = threading.Thread(target=self._writer_thread, name='AsyncWriter')
+        t.daemon = True
+        t.start()
+        return self
+
+    def _buffer(self):
+        buf = getattr(self._tls, 'buf', None)
+        if buf is None:
+            buf = self._tls.buf = _LineBuffer(threading.current_thread())
+            with self._b_lock:
+                self._bufs.append(buf)
+        return buf
+
+    def write(self, s):
+        # return: False if dropped.
+        if self._closed:
+            print(s)
+            return True
+        buf = self._buffer()
+        n = len(s) + 1
+        with buf.lock:
+            if buf.size and buf.size + n > self._buf_b:
+                buf.dropped += 1
+                return False
+            half = buf.size * 2 <= self._buf_b
+            buf.lines.append((next(self._seq), s))
+            buf.size += n
+        if half and buf.size * 2 > self._buf_b:
+            self._wake.set()
+        if self._closed:
+            self.flush()		# closed while appending
+        return True
+
+    def flush(self):
+        with self._w_lock:
+            with self._b_lock:
+                bufs = list(self._bufs)
+            runs = []
+            dropped = 0
+            for buf in bufs:
+                with buf.lock:
+                    lines, buf.lines = buf.lines, []
+                    buf.size = 0
+                    dropped += buf.dropped
+                    buf.dropped = 0
+                if lines:
+                    runs.append(lines)
+                if not buf.thread.is_alive():
+                    with self._b_lock:
+                        self._bufs.remove(buf)
+            lines = [s for _, s in heapq.merge(*runs)]
+            if dropped:
+                self.dropped += dropped
+                lines.append('-- %d lines dropped by buffer overflow --' % dropped)
+            if lines:
+                stream = self._stream or sys.stdout
+                lines.append('')
+                stream.write('\n'.join(lines))
+                stream.flush()
+
+    def _writer_thread(self):
+        while not self._closed:
+            self._wake.wait(self._interval_s)
+            self._wake.clear()
+            try:
+                self.flush()
+            except:
+                if not self._closed:
+                    traceback.print_exc()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
 #----------------------------------------------------------------------------
 #----------------------------------------------------------------------------
 
@@ -282,7 +485,11 @@ class BufferedPrint(object):
 
     def __new__(cls, size_b=None, printer=None):
         def _printer(fmt, *args):
-            print(fmt % args)
+            writer = _Printer._writer
+            if writer is not None:
+                writer.write(fmt % args)
+            else:
+                print(fmt % args)
         self = super().__new__(cls)
         self._size_b = size_b if size_b else 8192
         self.printer = printer if printer else _printer